@@ -0,0 +1,152 @@
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+import telebot
+from requests.adapters import HTTPAdapter
+
+
+API_RATE = float(os.getenv('ARCHIVER_API_RATE', '30'))
+API_BURST = int(os.getenv('ARCHIVER_API_BURST', '60'))
+API_MAX_RETRIES = int(os.getenv('ARCHIVER_API_MAX_RETRIES', '5'))
+API_BACKOFF_BASE = float(os.getenv('ARCHIVER_API_BACKOFF_BASE', '0.5'))
+API_BACKOFF_MAX = float(os.getenv('ARCHIVER_API_BACKOFF_MAX', '30'))
+API_POOL_SIZE = int(os.getenv('ARCHIVER_API_POOL_SIZE', '16'))
+API_TIMEOUT = (10, 60)
+DEFAULT_API_URL = "https://api.telegram.org/bot{0}/{1}"
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+logger = logging.getLogger('TeleBot')
+
+
+class IncompleteDownloadError(IOError):
+    pass
+
+
+def backoff_delay(attempt, base, maximum):
+    delay = min(maximum, base * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def retry_after(error):
+    if isinstance(error, telebot.apihelper.ApiTelegramException):
+        parameters = (error.result_json or {}).get('parameters') or {}
+        value = parameters.get('retry_after')
+    elif isinstance(error, telebot.apihelper.ApiHTTPException):
+        value = error.result.headers.get('Retry-After')
+    else:
+        return None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def is_retryable(error):
+    if isinstance(error, telebot.apihelper.ApiTelegramException):
+        return error.error_code in RETRYABLE_STATUS_CODES
+    if isinstance(error, telebot.apihelper.ApiHTTPException):
+        return error.result.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (requests.ConnectionError, requests.Timeout,
+                              requests.exceptions.ChunkedEncodingError, IncompleteDownloadError))
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self):
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                delay = self.paused_until - now
+                if delay <= 0:
+                    if self.rate <= 0:
+                        return waited
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class BotApiClient:
+    def __init__(self, token, rate=API_RATE, burst=API_BURST, max_retries=API_MAX_RETRIES,
+                 backoff_base=API_BACKOFF_BASE, backoff_max=API_BACKOFF_MAX, pool_size=API_POOL_SIZE):
+        self.token = token
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.limiter = TokenBucket(rate, burst)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.throttle_wait = 0.0
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.throttle_wait += self.limiter.acquire()
+            self.requests += 1
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = backoff_delay(attempt, self.backoff_base, self.backoff_max)
+                wait = retry_after(e)
+                if wait is not None:
+                    self.throttled += 1
+                    self.limiter.pause(wait)
+                    delay = max(delay, wait)
+                self.retries += 1
+                attempt += 1
+                logger.info(
+                    f"Ошибка запроса к Bot API ({e.__class__.__name__}), попытка {attempt} из {self.max_retries} через {delay:.1f} с")
+                time.sleep(delay)
+
+    def _get_file(self, file_id):
+        url = (telebot.apihelper.API_URL or DEFAULT_API_URL).format(self.token, 'getFile')
+        response = self.session.post(url, data={'file_id': file_id}, timeout=API_TIMEOUT,
+                                     proxies=telebot.apihelper.proxy)
+        try:
+            result_json = response.json()
+        except ValueError:
+            raise telebot.apihelper.ApiHTTPException('getFile', response)
+        if not result_json.get('ok'):
+            raise telebot.apihelper.ApiTelegramException('getFile', response, result_json)
+        return telebot.types.File.de_json(result_json['result'])
+
+    def get_file(self, file_id):
+        return self.call(self._get_file, file_id)
+
+    def open_stream(self, url, headers=None):
+        return self.session.get(url, headers=headers, stream=True, timeout=API_TIMEOUT,
+                                proxies=telebot.apihelper.proxy)
+
+    def stats(self):
+        return {'requests': self.requests, 'retries': self.retries,
+                'throttled': self.throttled, 'throttle_wait': round(self.throttle_wait, 3)}
+
+    def close(self):
+        self.session.close()
@@ -1,33 +1,217 @@
 import telebot
+import requests
 import os
 import re
+import sys
 import logging
+import queue
+import threading
+import hashlib
+from collections import OrderedDict
+import zlib
+import json
+import time
+import functools
+import subprocess
 from datetime import datetime, timezone
 
+from archive_api import BotApiClient, IncompleteDownloadError, is_retryable
+from archive_export import EXPORT_CONTAINER, EXPORT_DIR, default_export_path, format_progress, format_size
+from archive_journal import (JOURNAL_CHECKPOINT_INTERVAL, JOURNAL_COMMIT_INTERVAL, JOURNAL_DIR, JOURNAL_ENABLED,
+                             JOURNAL_SEGMENT_BYTES, UpdateJournal)
+from archive_media import (CHAT_MEDIA_MAX_BYTES, DEDUP_BLOB_DIR, DEDUP_CACHE_SIZE, DEDUP_DB_PATH, DOWNLOAD_QUEUE_SIZE,
+                           DOWNLOAD_RETRY_ATTEMPTS, DOWNLOAD_RETRY_DB_PATH, DOWNLOAD_RETRY_DELAY,
+                           DOWNLOAD_RETRY_MAX_DELAY, DOWNLOAD_RETRY_POLL_INTERVAL, DOWNLOAD_WORKERS, MEDIA_ARCHIVE_DIR,
+                           MEDIA_COLD_DIR, MEDIA_GROUP_CONCURRENCY, MEDIA_MAX_AGE, MEDIA_MAX_BYTES,
+                           MEDIA_RETENTION_INTERVAL, MEDIA_SKIP_LARGER, PARTIAL_FILE_MAX_AGE, PARTIAL_FILE_SUFFIX,
+                           STORAGE_DB_PATH, DownloadRetryQueue, MediaDedupIndex, MediaDownloadPool, MediaStorage,
+                           parse_size_limits, remove_stale_partials)
+from archive_metrics import Counter, CounterFunction, GaugeFunction, Histogram, start_metrics_server
+from archive_search import SEARCH_DB_PATH, SearchIndex, format_search_result, parse_time
+from archive_store import (CONTENT_TYPES_WITH_FILES, LOG_ROTATE_BYTES, LOG_ROTATE_INTERVAL, LOGS_DIR,
+                           SEGMENT_COMPRESSION, SEGMENT_MAX_BYTES, STRUCTURED_ARCHIVE_DIR, ChatLogWriter,
+                           RotatingTextLogs, SegmentCompressor, StructuredArchive, build_edit_history,
+                           format_log_entry_human_readable)
+
 
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN',
                       'TELEGRAM_BOT_TOKEN_HERE')
-MEDIA_ARCHIVE_DIR = 'media_archive'
 LOG_FILE_PREFIX = 'chatlog'
 LOG_FILE_EXTENSION = '.log'
+RUN_MODE = os.getenv('ARCHIVER_MODE', 'polling')
+DISPATCH_WORKERS = int(os.getenv('ARCHIVER_DISPATCH_WORKERS', '4'))
+DISPATCH_QUEUE_SIZE = int(os.getenv('ARCHIVER_DISPATCH_QUEUE_SIZE', '1000'))
+CHAT_STATE_FILE = os.getenv('ARCHIVER_CHAT_STATE_FILE', 'chat_logs.json')
+CHAT_RENAME_POLICY = os.getenv('ARCHIVER_CHAT_RENAME_POLICY', 'keep')
+LOG_FORMATS = set(os.getenv('ARCHIVER_LOG_FORMATS', 'text,jsonl').split(','))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('ARCHIVER_DOWNLOAD_CHUNK_SIZE', str(64 * 1024)))
+FILE_URL = os.getenv('ARCHIVER_FILE_URL',
+                     'https://api.telegram.org/file/bot{0}/{1}')
+LOG_MAX_OPEN_FILES = int(os.getenv('ARCHIVER_LOG_MAX_OPEN_FILES', '256'))
+LOG_FLUSH_INTERVAL = float(os.getenv('ARCHIVER_LOG_FLUSH_INTERVAL', '1.0'))
+LOG_FLUSH_BYTES = int(os.getenv('ARCHIVER_LOG_FLUSH_BYTES', str(64 * 1024)))
+LOG_FSYNC_MODE = os.getenv('ARCHIVER_LOG_FSYNC', 'none')
+DEDUP_CONTENT_HASH = os.getenv('ARCHIVER_DEDUP_CONTENT_HASH', '1') == '1'
+SEARCH_RESULTS_LIMIT = 10
+EXPORT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive_export.py')
+EXPORT_PROGRESS_INTERVAL = float(os.getenv('ARCHIVER_EXPORT_PROGRESS_INTERVAL', '10'))
+EXPORT_SEND_MAX_BYTES = 50 * 1024 * 1024
+EXPORT_NICE = 10
+EDIT_COALESCE_WINDOW = float(os.getenv('ARCHIVER_EDIT_COALESCE_WINDOW', '5'))
+COMPACT_INTERVAL = float(os.getenv('ARCHIVER_COMPACT_INTERVAL', '3600'))
+MEDIA_GROUP_WINDOW = float(os.getenv('ARCHIVER_MEDIA_GROUP_WINDOW', '1.0'))
+MEDIA_GROUP_MAX_ITEMS = 10
+METRICS_HOST = os.getenv('ARCHIVER_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('ARCHIVER_METRICS_PORT', '9108'))
 
 logger = telebot.logger
-telebot.logger.setLevel(logging.INFO)
-
-if not BOT_TOKEN or BOT_TOKEN == 'TELEGRAM_BOT_TOKEN_HERE':
-    logger.error(
-        "Пожалуйста, укажите ваш токен Telegram бота в переменной окружения TELEGRAM_BOT_TOKEN или замените плейсхолдер в коде!")
-    exit()
-bot = telebot.TeleBot(BOT_TOKEN)
-logger.info("Бот инициализирован.")
-
-try:
-    os.makedirs(MEDIA_ARCHIVE_DIR, exist_ok=True)
-    logger.info(f"Основная папка для медиа: {MEDIA_ARCHIVE_DIR}")
-except OSError as e:
-    logger.error(
-        f"Не удалось создать папку для медиа '{MEDIA_ARCHIVE_DIR}': {e}", exc_info=True)
-    exit()
+
+HANDLER_LATENCY = Histogram('archiver_handler_seconds',
+                            "Время обработки сообщения обработчиком", ['handler'])
+MESSAGES_ARCHIVED = Counter('archiver_messages_total',
+                            "Заархивировано сообщений", ['handler', 'content_type'])
+GET_FILE_LATENCY = Histogram('archiver_get_file_seconds',
+                             "Время запроса getFile к Bot API")
+DOWNLOAD_LATENCY = Histogram('archiver_download_seconds',
+                             "Время скачивания медиафайла")
+MEDIA_GROUP_DOWNLOAD_LATENCY = Histogram('archiver_media_group_download_seconds',
+                                         "Время скачивания всех файлов альбома")
+DOWNLOADED_BYTES = Counter('archiver_downloaded_bytes_total',
+                           "Скачано байт медиафайлов")
+LOG_APPEND_LATENCY = Histogram('archiver_log_append_seconds',
+                               "Время записи сообщения в архив", ['format'])
+ERRORS = Counter('archiver_errors_total',
+                 "Ошибки по этапам и классам", ['stage', 'error'])
+
+
+def error_class(error):
+    if isinstance(error, telebot.apihelper.ApiTelegramException):
+        return 'api'
+    if isinstance(error, (telebot.apihelper.ApiHTTPException, requests.RequestException)):
+        return 'http'
+    if isinstance(error, OSError):
+        return 'os'
+    return 'unexpected'
+
+
+def timed_handler(name):
+    latency = HANDLER_LATENCY.labels(name)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(message):
+            with latency.time():
+                return func(message)
+        return wrapper
+    return decorator
+
+
+def update_chat_id(update):
+    message = update.message or update.edited_message or update.channel_post or update.edited_channel_post
+    return message.chat.id if message is not None else None
+
+
+class UpdateDispatcher:
+    def __init__(self, process_updates, num_workers, queue_size):
+        self.process_updates = process_updates
+        self.num_workers = max(1, num_workers)
+        self.queues = [queue.Queue(maxsize=queue_size)
+                       for _ in range(self.num_workers)]
+        self.threads = []
+        self.shard_stats = [{'processed': 0, 'last_lag': 0.0, 'max_lag': 0.0}
+                            for _ in range(self.num_workers)]
+
+    def start(self):
+        for i, q in enumerate(self.queues):
+            thread = threading.Thread(
+                target=self._worker, args=(i, q), name=f"update-dispatch-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logger.info(
+            f"Запущено потоков обработки обновлений: {self.num_workers}")
+
+    def _shard(self, update):
+        chat_id = update_chat_id(update)
+        if chat_id is None:
+            return 0
+        return zlib.crc32(str(chat_id).encode()) % self.num_workers
+
+    def submit(self, updates):
+        for update in updates:
+            self.queues[self._shard(update)].put((time.monotonic(), update))
+
+    def is_saturated(self):
+        return any(q.full() for q in self.queues)
+
+    def _worker(self, shard, q):
+        stats = self.shard_stats[shard]
+        while True:
+            item = q.get()
+            try:
+                if item is None:
+                    return
+                enqueued_at, update = item
+                lag = time.monotonic() - enqueued_at
+                stats['last_lag'] = lag
+                stats['max_lag'] = max(stats['max_lag'], lag)
+                self.process_updates([update])
+                stats['processed'] += 1
+            except Exception as e:
+                logger.error(
+                    f"Ошибка обработки обновления в потоке {shard}: {e}", exc_info=True)
+            finally:
+                q.task_done()
+
+    def stats(self):
+        return [{'shard': i, 'queue_depth': q.qsize(), **self.shard_stats[i]}
+                for i, q in enumerate(self.queues)]
+
+    def stop(self, timeout=None):
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+
+class ArchiverBot(telebot.TeleBot):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dispatcher = None
+        self.journal = None
+
+    def process_new_updates(self, updates):
+        if self.journal is not None:
+            self.journal.append(updates)
+        for update in updates:
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+        self.replay_updates(updates)
+
+    def replay_updates(self, updates):
+        if self.dispatcher is not None:
+            self.dispatcher.submit(updates)
+        else:
+            self.handle_updates(updates)
+
+    def handle_updates(self, updates):
+        try:
+            for kind, process in (('message', self.process_new_messages),
+                                  ('edited_message', self.process_new_edited_messages),
+                                  ('channel_post', self.process_new_channel_posts),
+                                  ('edited_channel_post', self.process_new_edited_channel_posts)):
+                messages = [getattr(update, kind) for update in updates if getattr(update, kind) is not None]
+                if messages:
+                    process(messages)
+        finally:
+            if self.journal is not None:
+                for update in updates:
+                    self.journal.finish(update.update_id)
+
+
+bot = None
+api_client = None
+
 
 def sanitize_filename(name):
     if not name:
@@ -50,88 +234,6 @@ def sanitize_filename(name):
     return name
 
 
-def format_log_entry_human_readable(log_entry):
-    lines = []
-    lines.append("---")
-    timestamp = log_entry['timestamp_unix']
-    dt_object = datetime.fromtimestamp(timestamp, tz=timezone.utc)
-
-    if log_entry.get('edited'):
-        lines.append(
-            f"Статус: СООБЩЕНИЕ ИЗМЕНЕНО (ID: {log_entry['message_id']})")
-        lines.append(
-            f"Время изменения: {dt_object.strftime('%Y-%m-%d %H:%M:%S %Z')}")
-    else:
-        lines.append(f"Время: {dt_object.strftime('%Y-%m-%d %H:%M:%S %Z')}")
-
-        lines.append(f"ID Сообщения: {log_entry['message_id']}")
-
-    chat_info = log_entry['chat']
-    user_info = log_entry['user']
-    chat_desc = f"Чат ID: {chat_info['id']} ({chat_info['type']})"
-    if chat_info.get('title'):
-        chat_desc = f"Чат: {chat_info['title']} (ID: {chat_info['id']})"
-    elif chat_info.get('username'):
-        chat_desc += f" @{chat_info['username']}"
-    lines.append(chat_desc)
-
-    user_desc = f"От: {user_info['first_name']}"
-    if user_info.get('last_name'):
-        user_desc += f" {user_info['last_name']}"
-    if user_info.get('username'):
-        user_desc += f" (@{user_info['username']})"
-    user_desc += f" (ID: {user_info['id']})"
-    if user_info.get('is_bot'):
-        user_desc += " [БОТ]"
-    lines.append(user_desc)
-
-    lines.append(f"Тип: {log_entry['content_type']}")
-
-    if log_entry.get('text'):
-        lines.append(f"Текст: {log_entry['text']}")
-    if log_entry.get('caption'):
-        lines.append(f"Подпись: {log_entry['caption']}")
-
-    if log_entry.get('contact_details'):
-        contact = log_entry['contact_details']
-        contact_name = contact['first_name']
-        if contact.get('last_name'):
-            contact_name += f" {contact['last_name']}"
-        lines.append(f"Контакт: {contact_name}")
-        lines.append(f"Номер телефона: {contact['phone_number']}")
-        if contact.get('user_id'):
-            lines.append(f"Telegram ID: {contact['user_id']}")
-
-    if log_entry.get('poll_details'):
-        poll = log_entry['poll_details']
-        lines.append(f"Опрос: {poll['question']}")
-        if poll.get('options'):
-            lines.append("Варианты:")
-            for i, option in enumerate(poll['options']):
-                lines.append(f"  {i + 1}. {option}")
-
-    if not log_entry.get('edited') and log_entry['content_type'] in CONTENT_TYPES_WITH_FILES:
-        if log_entry.get('file_name'):
-            lines.append(f"Имя файла: {log_entry['file_name']}")
-        if log_entry.get('local_path'):
-            lines.append(f"Сохранен как: {log_entry['local_path']}")
-        elif log_entry.get('download_error'):
-            lines.append(f"Ошибка скачивания: {log_entry['download_error']}")
-        elif log_entry.get('file_id'):
-            lines.append(f"File ID: {log_entry['file_id']}")
-
-    if log_entry['content_type'] == 'sticker' and log_entry.get('sticker_emoji'):
-
-        lines.append(f"Стикер эмодзи: {log_entry['sticker_emoji']}")
-    if log_entry['content_type'] == 'location' and log_entry.get('location'):
-        loc = log_entry['location']
-        lines.append(f"Локация: lat={loc['latitude']}, lon={loc['longitude']}")
-
-    lines.append("---")
-    lines.append("")
-    return "\n".join(lines)
-
-
 def get_log_filename(chat, user):
     base_name = ""
     if chat.type == 'private':
@@ -146,21 +248,136 @@ def get_log_filename(chat, user):
     else:
         base_name = f"{chat.type}_{chat.id}"
     sanitized_base = sanitize_filename(base_name)
-    return f"{LOG_FILE_PREFIX}_{sanitized_base}{LOG_FILE_EXTENSION}"
+    return os.path.join(LOGS_DIR, sanitize_filename(str(chat.id)),
+                        f"{LOG_FILE_PREFIX}_{sanitized_base}{LOG_FILE_EXTENSION}")
+
+
+def chat_name_key(chat, user):
+    if chat.type == 'private':
+        return (chat.type, user.first_name, user.last_name, user.username)
+    return (chat.type, chat.title)
+
+
+class ChatStateCache:
+    RENAME_POLICIES = ('keep', 'rename', 'new')
+
+    def __init__(self, state_file, rename_policy):
+        if rename_policy not in self.RENAME_POLICIES:
+            raise ValueError(
+                f"rename_policy must be one of {self.RENAME_POLICIES}, got {rename_policy!r}")
+        self.state_file = state_file
+        self.rename_policy = rename_policy
+        self.states = {}
+        self.log_paths = None
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if self.log_paths is None:
+            try:
+                with open(self.state_file, 'r', encoding='utf-8') as f:
+                    self.log_paths = json.load(f)
+            except FileNotFoundError:
+                self.log_paths = {}
+            except (OSError, ValueError) as e:
+                logger.error(
+                    f"Не удалось прочитать файл состояния чатов '{self.state_file}': {e}", exc_info=True)
+                self.log_paths = {}
+        return self.log_paths
+
+    def _save(self):
+        tmp_path = self.state_file + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.log_paths, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.state_file)
+
+    def get(self, chat, user):
+        name_key = chat_name_key(chat, user)
+        state = self.states.get(chat.id)
+        if state is not None and state['name_key'] == name_key:
+            return state
+        with self.lock:
+            state = self.states.get(chat.id)
+            if state is not None and state['name_key'] == name_key:
+                return state
+            state = {
+                'name_key': name_key,
+                'log_filename': self._resolve_log_filename(chat, user),
+                'media_dir': os.path.join(MEDIA_ARCHIVE_DIR, sanitize_filename(str(chat.id))),
+                'media_dir_created': False,
+            }
+            self.states[chat.id] = state
+            return state
+
+    def _resolve_log_filename(self, chat, user):
+        log_paths = self._load()
+        new_filename = get_log_filename(chat, user)
+        known_filename = log_paths.get(str(chat.id))
+        if known_filename is None and os.path.exists(os.path.basename(new_filename)):
+            known_filename = os.path.basename(new_filename)
+        if known_filename is not None and not os.path.dirname(known_filename):
+            known_filename = self._migrate_legacy_log(known_filename, new_filename)
+        if known_filename is None or known_filename == new_filename:
+            log_filename = new_filename
+        elif self.rename_policy == 'keep':
+            logger.info(
+                f"Чат {chat.id} переименован, лог продолжает вестись в {known_filename}")
+            log_filename = known_filename
+        elif self.rename_policy == 'rename' and os.path.exists(known_filename) and not os.path.exists(new_filename):
+            try:
+                text_logs.rename_active(known_filename, new_filename)
+                logger.info(
+                    f"Чат {chat.id} переименован, лог {known_filename} переименован в {new_filename}")
+                log_filename = new_filename
+            except OSError as e:
+                logger.error(
+                    f"Не удалось переименовать лог {known_filename} в {new_filename}, лог продолжает вестись в прежнем файле: {e}", exc_info=True)
+                log_filename = known_filename
+        else:
+            logger.info(
+                f"Чат {chat.id} переименован, новый лог: {new_filename} (предыдущий: {known_filename})")
+            log_filename = new_filename
+        if known_filename != log_filename:
+            log_paths[str(chat.id)] = log_filename
+            try:
+                self._save()
+            except OSError as e:
+                logger.error(
+                    f"Не удалось сохранить файл состояния чатов '{self.state_file}': {e}", exc_info=True)
+        return log_filename
+
+    def _migrate_legacy_log(self, legacy_filename, new_filename):
+        migrated_filename = os.path.join(
+            os.path.dirname(new_filename), legacy_filename)
+        if os.path.exists(legacy_filename) and not os.path.exists(migrated_filename):
+            os.makedirs(os.path.dirname(migrated_filename), exist_ok=True)
+            os.rename(legacy_filename, migrated_filename)
+            logger.info(
+                f"Лог {legacy_filename} перенесен в {migrated_filename}")
+        return migrated_filename
+
+    def log_filename_for(self, chat_id, default):
+        state = self.states.get(chat_id)
+        return state['log_filename'] if state is not None else default
+
+    def ensure_media_dir(self, state):
+        if not state['media_dir_created']:
+            os.makedirs(state['media_dir'], exist_ok=True)
+            state['media_dir_created'] = True
+
+
+chat_states = ChatStateCache(CHAT_STATE_FILE, CHAT_RENAME_POLICY)
 
 
-@bot.message_handler(commands=['start'])
 def send_welcome(message):
     user = message.from_user
     chat = message.chat
 
-    log_filename = get_log_filename(chat, user)
-
-    chat_id_sanitized = sanitize_filename(str(chat.id))
-    chat_media_dir = os.path.join(MEDIA_ARCHIVE_DIR, chat_id_sanitized)
+    chat_state = chat_states.get(chat, user)
+    log_filename = chat_state['log_filename']
+    chat_media_dir = chat_state['media_dir']
 
     try:
-        os.makedirs(chat_media_dir, exist_ok=True)
+        chat_states.ensure_media_dir(chat_state)
         logger.info(f"Папка для медиа чата {chat.id}: {chat_media_dir}")
     except OSError as e:
         logger.error(
@@ -178,26 +395,618 @@ def send_welcome(message):
         f"Пользователь {user.id} ({user.username or 'no_username'}) запустил бота в чате {chat.id} (Тип: {chat.type}, Название: {getattr(chat, 'title', 'N/A')}). Лог: {log_filename}")
 
 
+def search_messages(message):
+    query = telebot.util.extract_arguments(message.text)
+    if not query:
+        bot.reply_to(message, "Использование: /search <текст>")
+        return
+    try:
+        results = search_index.search(
+            query, chat_id=message.chat.id, limit=SEARCH_RESULTS_LIMIT)
+    except Exception as e:
+        logger.error(
+            f"Ошибка поиска '{query}' в чате {message.chat.id}: {e}", exc_info=True)
+        bot.reply_to(message, "Не удалось выполнить поиск.")
+        return
+    if not results:
+        bot.reply_to(message, "Ничего не найдено.")
+        return
+    lines = [f"Найдено (последние {len(results)}):"]
+    lines.extend(format_search_result(result) for result in results)
+    bot.reply_to(message, "\n\n".join(lines))
+
+
+def is_chat_admin(chat, user):
+    if chat.type == 'private':
+        return True
+    member = bot.get_chat_member(chat.id, user.id)
+    return member.status in ('creator', 'administrator')
+
+
+class ExportJobs:
+    def __init__(self, export_dir, container, progress_interval):
+        self.export_dir = export_dir
+        self.container = container
+        self.progress_interval = progress_interval
+        self.running = {}
+        self.lock = threading.Lock()
+
+    def start(self, chat_id, since, until, message):
+        output = default_export_path(chat_id, self.container, self.export_dir)
+        command = [sys.executable, EXPORT_SCRIPT, str(chat_id), '-o', output,
+                   '--root', STRUCTURED_ARCHIVE_DIR, '--logs', LOGS_DIR,
+                   '--progress', 'json', '--nice', str(EXPORT_NICE)]
+        if since is not None:
+            command += ['--since', str(since)]
+        if until is not None:
+            command += ['--until', str(until)]
+        with self.lock:
+            if chat_id in self.running:
+                return False
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+            self.running[chat_id] = process
+        logger.info(
+            f"Запущен экспорт чата {chat_id} в {output} (процесс {process.pid})")
+        status = bot.reply_to(message, "Экспорт начат...")
+        threading.Thread(target=self._watch, args=(chat_id, process, status, output),
+                         name=f"export-{chat_id}", daemon=True).start()
+        return True
+
+    def _report(self, status, text):
+        try:
+            bot.edit_message_text(text, status.chat.id, status.message_id)
+        except Exception as e:
+            logger.debug(f"Не удалось обновить сообщение о ходе экспорта: {e}")
+
+    def _watch(self, chat_id, process, status, output):
+        last_report = time.monotonic()
+        for line in process.stdout:
+            try:
+                progress = json.loads(line)
+            except ValueError:
+                continue
+            if time.monotonic() - last_report >= self.progress_interval:
+                last_report = time.monotonic()
+                self._report(status, format_progress(progress))
+        returncode = process.wait()
+        with self.lock:
+            self.running.pop(chat_id, None)
+        if returncode != 0:
+            logger.error(f"Экспорт чата {chat_id} завершился с ошибкой (код {returncode})")
+            self._report(status, f"Экспорт не удался (код {returncode}).")
+            return
+        size = os.path.getsize(output)
+        logger.info(f"Экспорт чата {chat_id} сохранен в {output} ({size} байт)")
+        self._report(status, f"Экспорт готов: {output} ({format_size(size)})")
+        if size <= EXPORT_SEND_MAX_BYTES:
+            try:
+                with open(output, 'rb') as f:
+                    bot.send_document(chat_id, f, reply_to_message_id=status.message_id)
+            except Exception as e:
+                logger.error(f"Не удалось отправить экспорт чата {chat_id}: {e}", exc_info=True)
+
+    def stop(self):
+        with self.lock:
+            processes = list(self.running.items())
+        for chat_id, process in processes:
+            logger.warning(f"Экспорт чата {chat_id} прерван остановкой бота")
+            process.terminate()
+
+
+export_jobs = ExportJobs(EXPORT_DIR, EXPORT_CONTAINER, EXPORT_PROGRESS_INTERVAL)
+
+
+def export_chat_command(message):
+    args = (telebot.util.extract_arguments(message.text) or '').split()
+    try:
+        since = parse_time(args[0]) if len(args) > 0 else None
+        until = parse_time(args[1], end_of_day=True) if len(args) > 1 else None
+    except ValueError:
+        bot.reply_to(message, "Использование: /export [начало [конец]] (YYYY-MM-DD или unix time)")
+        return
+    try:
+        if not is_chat_admin(message.chat, message.from_user):
+            bot.reply_to(message, "Экспорт доступен только администраторам чата.")
+            return
+        if not export_jobs.start(message.chat.id, since, until, message):
+            bot.reply_to(message, "Экспорт этого чата уже выполняется.")
+    except Exception as e:
+        ERRORS.labels('export', error_class(e)).inc()
+        logger.error(
+            f"Ошибка запуска экспорта чата {message.chat.id}: {e}", exc_info=True)
+        bot.reply_to(message, "Не удалось запустить экспорт.")
+
+
+def format_quota(used, limit):
+    if limit > 0:
+        return f"{format_size(used)} из {format_size(limit)}"
+    return format_size(used)
+
+
+def storage_stats_command(message):
+    try:
+        if not is_chat_admin(message.chat, message.from_user):
+            bot.reply_to(message, "Статистика доступна только администраторам чата.")
+            return
+    except Exception as e:
+        logger.error(
+            f"Ошибка проверки прав в чате {message.chat.id}: {e}", exc_info=True)
+        bot.reply_to(message, "Не удалось получить статистику.")
+        return
+    usage = media_storage.usage(message.chat.id)
+    stats = media_storage.stats()
+    lines = [f"Медиа этого чата: {format_quota(usage['bytes'], media_storage.chat_max_bytes)}, файлов: {usage['files']}"]
+    if usage['cold_files']:
+        lines.append(
+            f"В холодном хранилище: {format_size(usage['cold_bytes'])}, файлов: {usage['cold_files']}")
+    lines.append(f"Всего медиа на диске: {format_quota(stats['total_bytes'], media_storage.total_max_bytes)}, "
+                 f"чатов: {stats['chats']}")
+    skipped = stats['skipped']
+    if any(skipped.values()):
+        lines.append(f"Не скачано с момента запуска: по размеру {skipped['size']}, "
+                     f"по квоте чата {skipped['chat_quota']}, по общей квоте {skipped['total_quota']}")
+    bot.reply_to(message, "\n".join(lines))
+
+
 CONTENT_TYPES_TO_ARCHIVE = ['text', 'audio', 'document', 'photo', 'sticker',
                             'video', 'video_note', 'voice', 'location', 'contact', 'venue', 'poll', 'dice']
-CONTENT_TYPES_WITH_FILES = ['audio', 'document',
-                            'photo', 'video', 'video_note', 'voice', 'sticker']
+DEFAULT_FILE_EXTENSIONS = {
+    'sticker': '.webp',
+    'photo': '.jpg',
+    'voice': '.ogg',
+    'video_note': '.mp4',
+    'video': '.mp4',
+    'audio': '.mp3',
+}
+
+
+log_writer = ChatLogWriter(LOG_MAX_OPEN_FILES, LOG_FLUSH_INTERVAL,
+                           LOG_FLUSH_BYTES, LOG_FSYNC_MODE)
+
+
+segment_compressor = SegmentCompressor(SEGMENT_COMPRESSION)
+structured_archive = StructuredArchive(STRUCTURED_ARCHIVE_DIR, log_writer,
+                                       SEGMENT_MAX_BYTES, segment_compressor)
+text_logs = RotatingTextLogs(log_writer, LOG_ROTATE_BYTES,
+                             LOG_ROTATE_INTERVAL, segment_compressor)
+
+
+search_index = SearchIndex(SEARCH_DB_PATH)
+
+
+def write_log_entry(log_filename, log_entry):
+    search_index.add(log_entry)
+    if 'jsonl' in LOG_FORMATS:
+        with LOG_APPEND_LATENCY.labels('jsonl').time():
+            structured_archive.write(log_entry)
+    if 'text' in LOG_FORMATS:
+        with LOG_APPEND_LATENCY.labels('text').time():
+            text_logs.write(log_filename, format_log_entry_human_readable(log_entry),
+                            log_entry['timestamp_unix'])
+
+
+class EditCoalescer:
+    def __init__(self, window, write):
+        self.window = window
+        self.write = write
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.edits_received = 0
+        self.edits_written = 0
+
+    def start(self):
+        if self.window > 0:
+            self.thread = threading.Thread(
+                target=self._run, name="edit-coalescer", daemon=True)
+            self.thread.start()
+
+    def add(self, log_filename, log_entry):
+        self.edits_received += 1
+        if self.thread is None:
+            self._write(log_filename, log_entry)
+            return
+        key = (log_entry['chat']['id'], log_entry['message_id'])
+        version = {'timestamp': log_entry['timestamp_unix'], 'text': log_entry.get('text'),
+                   'caption': log_entry.get('caption'), 'location': log_entry.get('location')}
+        with self.lock:
+            state = self.pending.get(key)
+            if state is None:
+                self.pending[key] = {'deadline': time.monotonic() + self.window,
+                                     'log_filename': log_filename, 'log_entry': log_entry,
+                                     'versions': [version]}
+            else:
+                state['log_filename'] = log_filename
+                state['log_entry'] = log_entry
+                state['versions'].append(version)
+
+    def _write(self, log_filename, log_entry):
+        self.edits_written += 1
+        try:
+            self.write(log_filename, log_entry)
+        except Exception as e:
+            ERRORS.labels('log', error_class(e)).inc()
+            logger.error(
+                f"Ошибка записи измененного сообщения в файл лога {log_filename}: {e}", exc_info=True)
+
+    def flush(self, force=False):
+        due = []
+        now = time.monotonic()
+        with self.lock:
+            while self.pending:
+                key, state = next(iter(self.pending.items()))
+                if not force and state['deadline'] > now:
+                    break
+                del self.pending[key]
+                due.append(state)
+        for state in due:
+            log_entry = state['log_entry']
+            if len(state['versions']) > 1:
+                log_entry['edit_count'] = len(state['versions'])
+                log_entry['edit_history'] = build_edit_history(
+                    state['versions'])
+            self._write(state['log_filename'], log_entry)
+
+    def _run(self):
+        while not self.stop_event.wait(min(self.window, 0.5)):
+            self.flush()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush(force=True)
+
+
+edit_coalescer = EditCoalescer(EDIT_COALESCE_WINDOW, write_log_entry)
+
+
+def guess_file_extension(content_type, original_filename, file_path):
+    if original_filename and '.' in original_filename:
+        return os.path.splitext(original_filename)[1]
+    if file_path and '.' in file_path:
+        return os.path.splitext(file_path)[1]
+    return DEFAULT_FILE_EXTENSIONS.get(content_type, '')
+
+
+def stream_download(file_path, save_path, chunk_size=DOWNLOAD_CHUNK_SIZE, hasher=None):
+    url = FILE_URL.format(bot.token, file_path)
+    part_path = save_path + PARTIAL_FILE_SUFFIX
+
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f"bytes={offset}-"} if offset else {}
+    with api_client.open_stream(url, headers) as response:
+        if response.status_code == 416 and offset:
+            os.remove(part_path)
+            return stream_download(file_path, save_path, chunk_size, hasher)
+        if response.status_code == 206 and offset:
+            mode = 'ab'
+            logger.debug(
+                f"Продолжение скачивания {save_path} с позиции {offset}")
+            if hasher is not None:
+                with open(part_path, 'rb') as part_file:
+                    for chunk in iter(lambda: part_file.read(chunk_size), b''):
+                        hasher.update(chunk)
+        elif response.status_code == 200:
+            mode = 'wb'
+            offset = 0
+        else:
+            raise telebot.apihelper.ApiHTTPException('Download file', response)
+
+        expected = response.headers.get('Content-Length')
+        written = 0
+        with open(part_path, mode) as part_file:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    part_file.write(chunk)
+                    written += len(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+
+    if expected is not None and written != int(expected):
+        raise IncompleteDownloadError(
+            f"incomplete download: got {written} of {expected} bytes, partial file kept at {part_path}")
+    os.replace(part_path, save_path)
+    return offset + written
+
+
+dedup_index = MediaDedupIndex(DEDUP_DB_PATH, DEDUP_BLOB_DIR, DEDUP_CACHE_SIZE)
+media_storage = MediaStorage(STORAGE_DB_PATH, dedup_index, CHAT_MEDIA_MAX_BYTES, MEDIA_MAX_BYTES,
+                             parse_size_limits(MEDIA_SKIP_LARGER), MEDIA_MAX_AGE, MEDIA_COLD_DIR,
+                             MEDIA_RETENTION_INTERVAL)
+
+
+def download_blob(file_path, blob_path):
+    hasher = hashlib.sha256() if DEDUP_CONTENT_HASH else None
+    size = stream_download(file_path, blob_path, hasher=hasher)
+    return size, hasher.hexdigest() if hasher else None
+
+
+def fetch_media(log_entry, chat_media_dir, chat_id):
+    content_type = log_entry['content_type']
+    file_id = log_entry['file_id']
+    file_unique_id = log_entry['file_unique_id']
+
+    save_path = None
+    retryable = False
+    try:
+        os.makedirs(chat_media_dir, exist_ok=True)
+        original_filename = log_entry.get('file_name')
+
+        with dedup_index.file_lock(file_unique_id):
+            blob = dedup_index.lookup(file_unique_id)
+            if blob is not None:
+                file_ext = os.path.splitext(blob['blob_path'])[1]
+                save_path = os.path.join(
+                    chat_media_dir, f"{file_unique_id}{file_ext}")
+                logger.debug(
+                    f"Файл {file_unique_id} уже есть в архиве ({blob['blob_path']}), повторное скачивание пропущено")
+                new_bytes = 0
+            else:
+                with GET_FILE_LATENCY.time():
+                    file_info = api_client.get_file(file_id)
+                file_ext = guess_file_extension(
+                    content_type, original_filename, file_info.file_path)
+                save_path = os.path.join(
+                    chat_media_dir, f"{file_unique_id}{file_ext}")
+                blob_path = dedup_index.blob_path_for(file_unique_id, file_ext)
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+                logger.debug(
+                    f"Попытка скачивания файла: {file_id} (unique: {file_unique_id}) для чата {chat_id} в {blob_path}")
+                with DOWNLOAD_LATENCY.time():
+                    size, sha256 = api_client.call(
+                        download_blob, file_info.file_path, blob_path)
+                DOWNLOADED_BYTES.inc(size)
+                blob = dedup_index.add(file_unique_id, blob_path, size, sha256)
+                new_bytes = size if blob['blob_path'] == blob_path else 0
+                logger.debug(
+                    f"Файл успешно скачан и сохранен: {blob['blob_path']} ({size} байт)")
+
+            log_entry['local_path'] = dedup_index.link_into(
+                blob['blob_path'], save_path)
+            media_storage.record(chat_id, file_unique_id, log_entry['local_path'], blob['size'],
+                                 content_type, new_bytes)
 
+        if not original_filename and file_ext:
+            log_entry['file_name'] = f"{file_unique_id}{file_ext}"
 
-@bot.message_handler(content_types=CONTENT_TYPES_TO_ARCHIVE)
+    except telebot.apihelper.ApiTelegramException as e:
+        ERRORS.labels('download', 'api').inc()
+        error_msg = f"Telegram API error ({e.error_code}): {e.description}"
+        logger.warning(
+            f"Ошибка скачивания файла {file_id} для чата {chat_id}: {error_msg}")
+        log_entry['download_error'] = error_msg
+        retryable = is_retryable(e)
+    except (telebot.apihelper.ApiHTTPException, requests.RequestException) as e:
+        ERRORS.labels('download', 'http').inc()
+        error_msg = f"HTTP error downloading file: {e}"
+        logger.warning(
+            f"Ошибка HTTP при скачивании файла {file_id} для чата {chat_id}: {error_msg}")
+        log_entry['download_error'] = error_msg
+        retryable = is_retryable(e)
+    except IncompleteDownloadError as e:
+        ERRORS.labels('download', 'incomplete').inc()
+        error_msg = f"Incomplete download: {e}"
+        logger.warning(
+            f"Файл {file_id} для чата {chat_id} скачан не полностью: {error_msg}")
+        log_entry['download_error'] = error_msg
+        retryable = True
+    except OSError as e:
+        ERRORS.labels('download', 'os').inc()
+        error_msg = f"OS error saving file: {e}"
+        logger.error(
+            f"Ошибка ОС при сохранении файла {file_id} в '{save_path}': {error_msg}", exc_info=True)
+        log_entry['download_error'] = error_msg
+        retryable = is_retryable(e)
+    except Exception as e:
+        ERRORS.labels('download', 'unexpected').inc()
+        error_msg = f"Unexpected error during download/save: {e}"
+        logger.error(
+            f"Неожиданная ошибка при обработке файла {file_id} для чата {chat_id}: {error_msg}", exc_info=True)
+        log_entry['download_error'] = error_msg
+    finally:
+        media_storage.release(chat_id, file_unique_id)
+    return retryable
+
+
+def write_download_update(job, log_entry):
+    chat_id = job['chat_id']
+    log_entry['download_update'] = True
+    log_entry['timestamp_unix'] = int(datetime.now(timezone.utc).timestamp())
+    if job.get('retry_attempts'):
+        log_entry['download_retry'] = job['retry_attempts']
+    log_filename = chat_states.log_filename_for(chat_id, job['log_filename'])
+    try:
+        write_log_entry(log_filename, log_entry)
+    except Exception as e:
+        ERRORS.labels('log', error_class(e)).inc()
+        logger.error(
+            f"Ошибка записи результата загрузки в файл лога {log_filename}: {e}", exc_info=True)
+
+
+def download_media(job):
+    log_entry = job['log_entry']
+    if fetch_media(log_entry, job['chat_media_dir'], job['chat_id']):
+        download_retries.add(dict(job, log_entry=dict(log_entry, download_error=None)))
+    write_download_update(job, log_entry)
+    download_retries.finish(job)
+
+
+def download_media_group(job, executor):
+    log_entry = job['log_entry']
+    items = [item for item in log_entry['media_group']
+             if item['file_id'] and not item['download_error'] and not item['local_path']]
+    with MEDIA_GROUP_DOWNLOAD_LATENCY.time():
+        futures = [executor.submit(fetch_media, item, job['chat_media_dir'], job['chat_id'])
+                   for item in items]
+        retryable = {id(item) for item, future in zip(items, futures) if future.result()}
+    if retryable:
+        retry_items = [dict(item, download_error=None) if id(item) in retryable else item
+                       for item in log_entry['media_group']]
+        download_retries.add(dict(job, log_entry=dict(log_entry, media_group=retry_items)))
+    write_download_update(job, log_entry)
+    download_retries.finish(job)
+
+
+download_pool = MediaDownloadPool(DOWNLOAD_WORKERS, DOWNLOAD_QUEUE_SIZE, MEDIA_GROUP_CONCURRENCY,
+                                  download_media, download_media_group)
+
+
+def submit_download(job):
+    download_retries.track(job)
+    if download_pool.submit(job):
+        return True
+    download_retries.finish(job)
+    return False
+
+
+download_retries = DownloadRetryQueue(DOWNLOAD_RETRY_DB_PATH, DOWNLOAD_RETRY_ATTEMPTS, DOWNLOAD_RETRY_DELAY,
+                                      DOWNLOAD_RETRY_MAX_DELAY, DOWNLOAD_RETRY_POLL_INTERVAL, submit_download)
+
+
+MEDIA_GROUP_ITEM_FIELDS = ('message_id', 'content_type', 'caption', 'file_id', 'file_unique_id',
+                           'file_name', 'local_path', 'download_error')
+
+
+def archive_media_group(group):
+    parts = sorted(group['parts'], key=lambda part: part['message_id'])
+    log_entry = dict(parts[0])
+    chat_id = log_entry['chat']['id']
+    items = []
+    for part in parts:
+        item = {field: part[field] for field in MEDIA_GROUP_ITEM_FIELDS}
+        if not (item['file_id'] and item['file_unique_id']):
+            item['download_error'] = "Missing file_id or file_unique_id"
+        items.append(item)
+    captions = [part['caption'] for part in parts if part['caption']]
+    log_entry.update({
+        'content_type': 'media_group', 'media_group_id': group['media_group_id'],
+        'media_group': items, 'caption': "\n".join(captions) or None,
+        'file_id': None, 'file_unique_id': None, 'file_name': None,
+    })
+
+    submitted = False
+    if any(not item['download_error'] for item in items):
+        job = {
+            'chat_id': chat_id,
+            'log_filename': group['log_filename'],
+            'chat_media_dir': group['chat_media_dir'],
+            'log_entry': dict(log_entry, media_group=[dict(item) for item in items]),
+        }
+        submitted = submit_download(job)
+        if not submitted:
+            logger.warning(
+                f"Очередь загрузки переполнена, файлы альбома {group['media_group_id']} в чате {chat_id} не будут скачаны.")
+            for item in items:
+                item['download_error'] = item['download_error'] or "Download queue is full"
+    for item in items:
+        if not submitted or item['download_error']:
+            media_storage.release(chat_id, item['file_unique_id'])
+
+    write_log_entry(group['log_filename'], log_entry)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            f"Альбом {group['media_group_id']} ({len(items)} файлов) из чата {chat_id} заархивирован в {group['log_filename']}.")
+
+
+class MediaGroupBuffer:
+    def __init__(self, window, max_items, write_group):
+        self.window = window
+        self.max_items = max_items
+        self.write_group = write_group
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.groups_written = 0
+
+    def start(self):
+        if self.window > 0:
+            self.thread = threading.Thread(
+                target=self._run, name="media-group-buffer", daemon=True)
+            self.thread.start()
+
+    def add(self, log_filename, chat_media_dir, media_group_id, log_entry):
+        if self.thread is None:
+            return False
+        key = (log_entry['chat']['id'], media_group_id)
+        with self.lock:
+            group = self.pending.get(key)
+            if group is None:
+                group = self.pending[key] = {'deadline': time.monotonic() + self.window,
+                                             'media_group_id': media_group_id, 'parts': []}
+            group['log_filename'] = log_filename
+            group['chat_media_dir'] = chat_media_dir
+            group['parts'].append(log_entry)
+            complete = len(group['parts']) >= self.max_items
+            if complete:
+                del self.pending[key]
+        if complete:
+            self._write(group)
+        return True
+
+    def _write(self, group):
+        self.groups_written += 1
+        try:
+            self.write_group(group)
+        except Exception as e:
+            ERRORS.labels('log', error_class(e)).inc()
+            logger.error(
+                f"Ошибка записи альбома {group['media_group_id']} в файл лога {group['log_filename']}: {e}", exc_info=True)
+
+    def flush(self, force=False):
+        due = []
+        now = time.monotonic()
+        with self.lock:
+            while self.pending:
+                key, group = next(iter(self.pending.items()))
+                if not force and group['deadline'] > now:
+                    break
+                del self.pending[key]
+                due.append(group)
+        for group in due:
+            self._write(group)
+
+    def flush_chat(self, chat_id):
+        if not self.pending:
+            return
+        with self.lock:
+            keys = [key for key in self.pending if key[0] == chat_id]
+            due = [self.pending.pop(key) for key in keys]
+        for group in due:
+            self._write(group)
+
+    def _run(self):
+        while not self.stop_event.wait(min(self.window, 0.5)):
+            self.flush()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush(force=True)
+
+
+media_groups = MediaGroupBuffer(MEDIA_GROUP_WINDOW, MEDIA_GROUP_MAX_ITEMS, archive_media_group)
+
+
+@timed_handler('archive_message')
 def archive_message(message):
     try:
         chat = message.chat
         user = message.from_user
         content_type = message.content_type
 
-        log_filename = get_log_filename(chat, user)
-
-        chat_id_sanitized = sanitize_filename(str(chat.id))
-        chat_media_dir = os.path.join(MEDIA_ARCHIVE_DIR, chat_id_sanitized)
+        chat_state = chat_states.get(chat, user)
+        log_filename = chat_state['log_filename']
+        chat_media_dir = chat_state['media_dir']
 
         try:
-            os.makedirs(chat_media_dir, exist_ok=True)
+            chat_states.ensure_media_dir(chat_state)
         except OSError as e:
             logger.error(
                 f"Не удалось создать папку для медиа чата '{chat_media_dir}' при обработке сообщения {message.message_id}: {e}", exc_info=True)
@@ -283,86 +1092,44 @@ def archive_message(message):
                 'is_closed': poll.is_closed,
             }
         if file_to_download and content_type in CONTENT_TYPES_WITH_FILES:
-            file_id = log_entry.get('file_id')
-            file_unique_id = log_entry.get('file_unique_id')
-
-            if file_id and file_unique_id:
-                save_path = None
-                try:
-                    os.makedirs(chat_media_dir, exist_ok=True)
-
-                    file_info = bot.get_file(file_id)
-                    file_ext = ''
-
-                    original_filename = log_entry.get('file_name')
-
-                    if original_filename and '.' in original_filename:
-                        _, file_ext = os.path.splitext(original_filename)
-                    elif file_info.file_path and '.' in file_info.file_path:
-                        _, file_ext = os.path.splitext(file_info.file_path)
-                    else:
-                        if content_type == 'sticker':
-                            file_ext = '.webp'
-                        elif content_type == 'photo':
-                            file_ext = '.jpg'
-                        elif content_type == 'voice':
-                            file_ext = '.ogg'
-                        elif content_type == 'video_note':
-                            file_ext = '.mp4'
-                        elif content_type == 'video':
-                            file_ext = '.mp4'
-                        elif content_type == 'audio':
-                            file_ext = '.mp3'
-
-                    local_filename = f"{file_unique_id}{file_ext}"
-                    save_path = os.path.join(chat_media_dir, local_filename)
-
-                    if original_filename and original_filename != local_filename:
-                        log_entry['file_name'] = original_filename
-                    elif not original_filename and file_ext:
-                        log_entry['file_name'] = local_filename
-
-                    logger.info(
-                        f"Попытка скачивания файла: {file_id} (unique: {file_unique_id}) для чата {chat.id} в {save_path}")
-                    downloaded_file = bot.download_file(file_info.file_path)
-                    with open(save_path, 'wb') as new_file:
-                        new_file.write(downloaded_file)
-
-                    log_entry['local_path'] = save_path
-                    logger.info(f"Файл успешно скачан и сохранен: {save_path}")
-
-                except telebot.apihelper.ApiTelegramException as e:
-                    error_msg = f"Telegram API error ({e.error_code}): {e.description}"
+            log_entry['download_error'] = media_storage.check(
+                chat.id, content_type, log_entry['file_unique_id'], getattr(file_to_download, 'file_size', None))
+            if log_entry['download_error'] and logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    f"Файл {log_entry['file_id']} из сообщения {message.message_id} в чате {chat.id} не будет скачан: {log_entry['download_error']}")
+        if message.media_group_id and file_to_download and media_groups.add(
+                log_filename, chat_media_dir, message.media_group_id, log_entry):
+            MESSAGES_ARCHIVED.labels('archive_message', content_type).inc()
+            return
+        media_groups.flush_chat(chat.id)
+
+        if file_to_download and content_type in CONTENT_TYPES_WITH_FILES and not log_entry['download_error']:
+            if log_entry.get('file_id') and log_entry.get('file_unique_id'):
+                job = {
+                    'chat_id': chat.id,
+                    'log_filename': log_filename,
+                    'chat_media_dir': chat_media_dir,
+                    'log_entry': dict(log_entry),
+                }
+                if not submit_download(job):
                     logger.warning(
-                        f"Ошибка скачивания файла {file_id} для чата {chat.id}: {error_msg}")
-                    log_entry['download_error'] = error_msg
-                except OSError as e:
-                    error_msg = f"OS error saving file: {e}"
-                    logger.error(
-                        f"Ошибка ОС при сохранении файла {file_id} в '{save_path}': {error_msg}", exc_info=True)
-                    log_entry['download_error'] = error_msg
-                except IOError as e:
-                    error_msg = f"IO error saving file: {e}"
-                    logger.error(
-                        f"Ошибка ввода/вывода при сохранении файла {file_id} в '{save_path}': {error_msg}", exc_info=True)
-                    log_entry['download_error'] = error_msg
-                except Exception as e:
-                    error_msg = f"Unexpected error during download/save: {e}"
-                    logger.error(
-                        f"Неожиданная ошибка при обработке файла {file_id} для чата {chat.id}: {error_msg}", exc_info=True)
-                    log_entry['download_error'] = error_msg
+                        f"Очередь загрузки переполнена, файл {log_entry['file_id']} из сообщения {message.message_id} в чате {chat.id} не будет скачан.")
+                    log_entry['download_error'] = "Download queue is full"
+                    media_storage.release(chat.id, log_entry['file_unique_id'])
             else:
                 logger.warning(
                     f"Отсутствует file_id или file_unique_id для медиа в сообщении {message.message_id} (тип: {content_type}) в чате {chat.id}, скачивание невозможно.")
                 log_entry['download_error'] = "Missing file_id or file_unique_id"
+                media_storage.release(chat.id, log_entry['file_unique_id'])
 
         try:
-            log_string = format_log_entry_human_readable(log_entry)
-            with open(log_filename, 'a', encoding='utf-8') as f:
-                f.write(log_string)
-            logger.info(
-                f"Сообщение {log_entry['message_id']} ({content_type}) из чата {chat.id} пользователя {user.id} заархивировано в {log_filename}.")
+            write_log_entry(log_filename, log_entry)
+            MESSAGES_ARCHIVED.labels('archive_message', content_type).inc()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    f"Сообщение {log_entry['message_id']} ({content_type}) из чата {chat.id} пользователя {user.id} заархивировано в {log_filename}.")
         except Exception as e:
+            ERRORS.labels('log', error_class(e)).inc()
             logger.error(
                 f"Ошибка записи в файл лога {log_filename}: {e}", exc_info=True)
 
@@ -371,18 +1138,19 @@ def archive_message(message):
             message, 'chat') else 'UNKNOWN_CHAT'
         message_id_for_error = message.message_id if message and hasattr(
             message, 'message_id') else 'UNKNOWN_MSG'
+        ERRORS.labels('handler', error_class(e)).inc()
         logger.error(
             f"Критическая ошибка при обработке сообщения {message_id_for_error} в чате {chat_id_for_error}: {e}", exc_info=True)
 
 
-@bot.edited_message_handler(content_types=CONTENT_TYPES_TO_ARCHIVE)
+@timed_handler('archive_edited_message')
 def archive_edited_message(message):
     try:
         chat = message.chat
         user = message.from_user
         content_type = message.content_type
 
-        log_filename = get_log_filename(chat, user)
+        log_filename = chat_states.get(chat, user)['log_filename']
 
         edit_timestamp = getattr(message, 'edit_date', None)
         if not edit_timestamp:
@@ -414,13 +1182,13 @@ def archive_edited_message(message):
             log_entry['sticker_emoji'] = message.sticker.emoji
 
         try:
-            log_string = format_log_entry_human_readable(
-                log_entry)
-            with open(log_filename, 'a', encoding='utf-8') as f:
-                f.write(log_string)
-            logger.info(
-                f"Измененное сообщение {log_entry['message_id']} ({content_type}) из чата {chat.id} пользователя {user.id} заархивировано в {log_filename}.")
+            edit_coalescer.add(log_filename, log_entry)
+            MESSAGES_ARCHIVED.labels('archive_edited_message', content_type).inc()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    f"Измененное сообщение {log_entry['message_id']} ({content_type}) из чата {chat.id} пользователя {user.id} принято к архивированию в {log_filename}.")
         except Exception as e:
+            ERRORS.labels('log', error_class(e)).inc()
             logger.error(
                 f"Ошибка записи измененного сообщения в файл лога {log_filename}: {e}", exc_info=True)
 
@@ -429,22 +1197,202 @@ def archive_edited_message(message):
             message, 'chat') else 'UNKNOWN_CHAT'
         message_id_for_error = message.message_id if message and hasattr(
             message, 'message_id') else 'UNKNOWN_MSG'
+        ERRORS.labels('handler', error_class(e)).inc()
         logger.error(
             f"Критическая ошибка при обработке ИЗМЕНЕННОГО сообщения {message_id_for_error} в чате {chat_id_for_error}: {e}", exc_info=True)
 
 
-if __name__ == '__main__':
-    logger.info("Запуск бота (polling)...")
+def create_bot(token):
+    global bot, api_client
+    bot = ArchiverBot(token, threaded=False)
+    api_client = BotApiClient(token)
+    bot.register_message_handler(send_welcome, commands=['start'])
+    bot.register_message_handler(search_messages, commands=['search'])
+    bot.register_message_handler(export_chat_command, commands=['export'])
+    bot.register_message_handler(storage_stats_command, commands=['stats'])
+    bot.register_message_handler(
+        archive_message, content_types=CONTENT_TYPES_TO_ARCHIVE)
+    bot.register_edited_message_handler(
+        archive_edited_message, content_types=CONTENT_TYPES_TO_ARCHIVE)
+    logger.info("Бот инициализирован.")
+    return bot
+
+
+def dispatcher_metric(key):
+    if bot is None or bot.dispatcher is None:
+        return []
+    return [((shard['shard'],), shard[key]) for shard in bot.dispatcher.stats()]
+
+
+def api_client_metric(key):
+    return api_client.stats()[key] if api_client is not None else 0
+
+
+def journal_metric(key):
+    if bot is None or bot.journal is None:
+        return 0
+    return bot.journal.stats()[key]
+
+
+GaugeFunction('archiver_download_queue_depth',
+              "Медиафайлов в очереди на скачивание", lambda: download_pool.pending())
+GaugeFunction('archiver_dispatch_queue_depth', "Обновлений в очереди потока обработки",
+              lambda: dispatcher_metric('queue_depth'), ['shard'])
+GaugeFunction('archiver_dispatch_lag_seconds', "Время ожидания последнего обновления в очереди потока",
+              lambda: dispatcher_metric('last_lag'), ['shard'])
+CounterFunction('archiver_dedup_lookups_total', "Обращения к индексу дедупликации медиа",
+                lambda: [(('hit',), dedup_index.hits), (('miss',), dedup_index.misses),
+                         (('content_hit',), dedup_index.content_hits)], ['result'])
+CounterFunction('archiver_dedup_saved_bytes_total', "Байт, не скачанных и не записанных благодаря дедупликации",
+                lambda: dedup_index.bytes_saved)
+CounterFunction('archiver_edits_total', "Изменения сообщений: получено и записано после объединения",
+                lambda: [(('received',), edit_coalescer.edits_received),
+                         (('written',), edit_coalescer.edits_written)], ['stage'])
+CounterFunction('archiver_api_requests_total', "Запросов к Bot API (getFile и скачивание файлов)",
+                lambda: api_client_metric('requests'))
+CounterFunction('archiver_api_retries_total', "Повторов запросов к Bot API по причинам",
+                lambda: [(('throttled',), api_client_metric('throttled')),
+                         (('error',), api_client_metric('retries') - api_client_metric('throttled'))], ['reason'])
+CounterFunction('archiver_api_throttle_wait_seconds_total', "Время ожидания ограничителя частоты запросов",
+                lambda: api_client_metric('throttle_wait'))
+GaugeFunction('archiver_download_retry_queue_depth', "Загрузок, ожидающих повторной попытки",
+              lambda: download_retries.pending())
+CounterFunction('archiver_download_retries_total', "Повторные загрузки: запланировано, запущено, отменено",
+                lambda: [(('scheduled',), download_retries.scheduled),
+                         (('resubmitted',), download_retries.resubmitted),
+                         (('abandoned',), download_retries.abandoned)], ['result'])
+GaugeFunction('archiver_media_storage_bytes', "Место, занятое скачанными файлами медиа",
+              lambda: media_storage.total_bytes)
+CounterFunction('archiver_media_skipped_total', "Файлов медиа, не скачанных из-за ограничений размера и квот",
+                lambda: [((reason,), count) for reason, count in media_storage.stats()['skipped'].items()],
+                ['reason'])
+CounterFunction('archiver_media_expired_total', "Устаревших файлов медиа, удаленных или перенесенных",
+                lambda: [((action,), count) for action, count in media_storage.stats()['expired'].items()],
+                ['action'])
+CounterFunction('archiver_journal_updates_total', "Обновлений, записанных в журнал",
+                lambda: journal_metric('journaled'))
+CounterFunction('archiver_journal_commits_total', "Групповых записей журнала на диск (fsync)",
+                lambda: journal_metric('commits'))
+GaugeFunction('archiver_journal_pending_updates', "Обновлений в журнале, еще не записанных в архив",
+              lambda: journal_metric('pending'))
+CounterFunction('archiver_media_groups_total', "Альбомов, записанных одной записью",
+                lambda: media_groups.groups_written)
+CounterFunction('archiver_search_index_dropped_total', "Сообщений, не попавших в поисковый индекс",
+                lambda: search_index.dropped)
+
+
+def start_services():
+    if METRICS_PORT:
+        try:
+            start_metrics_server(METRICS_HOST, METRICS_PORT)
+            logger.info(
+                f"Метрики доступны по адресу http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        except OSError as e:
+            logger.error(
+                f"Не удалось запустить сервер метрик на {METRICS_HOST}:{METRICS_PORT}: {e}", exc_info=True)
+    log_writer.start()
+    search_index.start()
+    edit_coalescer.start()
+    structured_archive.start_compaction(COMPACT_INTERVAL)
+    removed = remove_stale_partials(DEDUP_BLOB_DIR, PARTIAL_FILE_MAX_AGE)
+    if removed:
+        logger.info(f"Удалено устаревших недокачанных файлов: {removed}")
+    media_storage.open(MEDIA_ARCHIVE_DIR)
+    media_storage.start()
+    download_retries.recover()
+    download_pool.start()
+    download_retries.start()
+    media_groups.start()
+    unfinished = []
+    if JOURNAL_ENABLED:
+        bot.journal = UpdateJournal(JOURNAL_DIR, JOURNAL_COMMIT_INTERVAL, JOURNAL_CHECKPOINT_INTERVAL,
+                                    JOURNAL_SEGMENT_BYTES, max(EDIT_COALESCE_WINDOW, MEDIA_GROUP_WINDOW) + 1,
+                                    log_writer.sync_all)
+        unfinished = bot.journal.open()
+        bot.last_update_id = max(bot.last_update_id, bot.journal.last_update_id)
+    if DISPATCH_WORKERS > 0:
+        bot.dispatcher = UpdateDispatcher(
+            bot.handle_updates, DISPATCH_WORKERS, DISPATCH_QUEUE_SIZE)
+        bot.dispatcher.start()
+    if unfinished:
+        bot.replay_updates([telebot.types.Update.de_json(data) for data in unfinished])
+
+
+def stop_services():
+    export_jobs.stop()
+    if bot.dispatcher is not None:
+        logger.info("Ожидание обработки полученных обновлений...")
+        bot.dispatcher.stop()
+        logger.info(f"Статистика потоков обработки: {bot.dispatcher.stats()}")
+        bot.dispatcher = None
+    edit_coalescer.stop()
+    media_groups.stop()
+    logger.info(
+        f"Изменений сообщений получено: {edit_coalescer.edits_received}, записано: {edit_coalescer.edits_written}")
+    download_retries.stop()
+    media_storage.stop()
+    logger.info(
+        f"Ожидание завершения загрузок медиа (в очереди: {download_pool.pending()})...")
+    download_pool.stop()
+    logger.info(
+        f"Статистика запросов к Bot API: {api_client.stats()}, повторных загрузок в очереди: {download_retries.pending()}")
+    download_retries.close()
+    api_client.close()
+    logger.info(f"Статистика дедупликации медиа: {dedup_index.stats()}")
+    logger.info(f"Статистика учета места медиа: {media_storage.stats()}")
+    media_storage.close()
+    dedup_index.close()
+    structured_archive.close()
+    text_logs.close()
+    log_writer.close_all()
+    if bot.journal is not None:
+        bot.journal.close()
+        logger.info(f"Статистика журнала обновлений: {bot.journal.stats()}")
+        bot.journal = None
+    segment_compressor.close()
+    search_index.close()
+
+
+def main():
+    telebot.logger.setLevel(logging.INFO)
+    if not BOT_TOKEN or BOT_TOKEN == 'TELEGRAM_BOT_TOKEN_HERE':
+        logger.error(
+            "Пожалуйста, укажите ваш токен Telegram бота в переменной окружения TELEGRAM_BOT_TOKEN или замените плейсхолдер в коде!")
+        return 1
+    create_bot(BOT_TOKEN)
+
+    try:
+        os.makedirs(MEDIA_ARCHIVE_DIR, exist_ok=True)
+        logger.info(f"Основная папка для медиа: {MEDIA_ARCHIVE_DIR}")
+    except OSError as e:
+        logger.error(
+            f"Не удалось создать папку для медиа '{MEDIA_ARCHIVE_DIR}': {e}", exc_info=True)
+        return 1
+
+    logger.info(f"Запуск бота ({RUN_MODE})...")
     print("Бот запущен и готов к работе. Нажмите Ctrl+C для остановки.")
+    start_services()
     try:
-        bot.infinity_polling(logger_level=logging.WARNING,
-                             timeout=60, long_polling_timeout=60)
+        if RUN_MODE == 'webhook':
+            from archive_webhook import run_webhook
+            run_webhook(bot, bot.process_new_updates,
+                        is_saturated=lambda: download_pool.is_saturated() or (
+                            bot.dispatcher is not None and bot.dispatcher.is_saturated()))
+        else:
+            bot.infinity_polling(logger_level=logging.WARNING,
+                                 timeout=60, long_polling_timeout=60)
     except KeyboardInterrupt:
         logger.info(
             "Получен сигнал остановки (KeyboardInterrupt). Завершение работы...")
         print("\nБот остановлен.")
     except Exception as e:
         logger.critical(
-            f"Критическая ошибка в главном цикле polling бота: {e}", exc_info=True)
+            f"Критическая ошибка в главном цикле бота ({RUN_MODE}): {e}", exc_info=True)
     finally:
+        stop_services()
         logger.info("Бот завершил работу.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
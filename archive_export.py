@@ -0,0 +1,370 @@
+import argparse
+import html
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+from datetime import datetime, timezone
+
+from archive_search import parse_time
+from archive_store import (LOGS_DIR, STRUCTURED_ARCHIVE_DIR, format_log_entry_human_readable, iter_chat_entries,
+                           list_segments, manifest_segments, zstandard)
+
+
+EXPORT_DIR = os.getenv('ARCHIVER_EXPORT_DIR', 'exports')
+EXPORT_CONTAINER = os.getenv('ARCHIVER_EXPORT_CONTAINER', 'zip')
+EXPORT_CONTAINERS = ('zip', 'tar.gz', 'tar.zst')
+EXPORT_FORMATS = ('html', 'json', 'text')
+EXPORT_PROGRESS_INTERVAL = 2.0
+EXPORT_FILES = {'html': 'messages.html', 'json': 'messages.json', 'text': 'messages.txt'}
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
+VIDEO_EXTENSIONS = {'.mp4', '.webm', '.mov'}
+AUDIO_EXTENSIONS = {'.mp3', '.ogg', '.oga', '.m4a', '.wav'}
+
+HTML_HEADER = """<!DOCTYPE html>
+<html lang="ru">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; max-width: 860px; margin: 0 auto; padding: 16px; }}
+.message {{ border-bottom: 1px solid #ddd; padding: 8px 0; }}
+.meta {{ color: #777; font-size: 90%; }}
+.media img, .media video {{ max-width: 480px; max-height: 480px; display: block; margin: 4px 0; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+"""
+HTML_FOOTER = "</body>\n</html>\n"
+
+logger = logging.getLogger('TeleBot')
+
+
+def default_export_path(chat_id, container=EXPORT_CONTAINER, export_dir=EXPORT_DIR):
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')
+    return os.path.join(export_dir, f"chat_{chat_id}_{stamp}.{container}")
+
+
+def format_size(size):
+    for unit in ('Б', 'КБ', 'МБ', 'ГБ'):
+        if size < 1024 or unit == 'ГБ':
+            return f"{size:.1f} {unit}" if unit != 'Б' else f"{size} {unit}"
+        size /= 1024
+
+
+def format_progress(progress):
+    if progress['stage'] == 'scan':
+        return f"Экспорт: просмотр архива, найдено сообщений: {progress['messages_total']}"
+    text = (f"Экспорт: сообщений {progress['messages']} из {progress['messages_total']}, "
+            f"медиа {format_size(progress['media_bytes'])} из {format_size(progress['media_bytes_total'])}")
+    if progress['stage'] == 'done':
+        text += f", архив {format_size(progress['output_bytes'])}"
+    return text
+
+
+class ProgressReporter:
+    def __init__(self, callback, interval=EXPORT_PROGRESS_INTERVAL):
+        self.callback = callback
+        self.interval = interval
+        self.last_report = 0.0
+        self.progress = {'stage': 'scan', 'messages': 0, 'messages_total': 0,
+                         'media_bytes': 0, 'media_bytes_total': 0, 'output_bytes': 0}
+
+    def update(self, force=False, **fields):
+        self.progress.update(fields)
+        now = time.monotonic()
+        if self.callback is not None and (force or now - self.last_report >= self.interval):
+            self.last_report = now
+            self.callback(dict(self.progress))
+
+
+class ZipExportWriter:
+    def __init__(self, path):
+        self.archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def add_file(self, path, arcname, compress=True):
+        self.archive.write(path, arcname, zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED)
+
+    def close(self):
+        self.archive.close()
+
+
+class TarExportWriter:
+    def __init__(self, path, compression):
+        self.stream = None
+        if compression == 'zstd':
+            if zstandard is None:
+                raise RuntimeError("zstandard is required for tar.zst exports: pip install zstandard")
+            self.stream = zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+            self.archive = tarfile.open(fileobj=self.stream, mode='w|')
+        else:
+            self.archive = tarfile.open(path, 'w|gz')
+
+    def add_file(self, path, arcname, compress=True):
+        self.archive.add(path, arcname=arcname, recursive=False)
+
+    def close(self):
+        self.archive.close()
+        if self.stream is not None:
+            self.stream.close()
+
+
+def open_export_writer(output_path, path):
+    if output_path.endswith('.zip'):
+        return ZipExportWriter(path)
+    if output_path.endswith('.tar.zst'):
+        return TarExportWriter(path, 'zstd')
+    if output_path.endswith(('.tar.gz', '.tgz')):
+        return TarExportWriter(path, 'gzip')
+    raise ValueError(f"unsupported export container: {output_path} (expected one of {EXPORT_CONTAINERS})")
+
+
+def in_range(log_entry, since, until):
+    timestamp = log_entry['timestamp_unix']
+    return (since is None or timestamp >= since) and (until is None or timestamp <= until)
+
+
+def entry_media_paths(log_entry):
+    if log_entry.get('local_path'):
+        yield log_entry['local_path']
+    for item in log_entry.get('media_group') or ():
+        if item.get('local_path'):
+            yield item['local_path']
+
+
+def media_tag(arcname):
+    src = html.escape(arcname, quote=True)
+    ext = os.path.splitext(arcname)[1].lower()
+    if ext in IMAGE_EXTENSIONS:
+        return f'<a href="{src}"><img src="{src}" loading="lazy"></a>'
+    if ext in VIDEO_EXTENSIONS:
+        return f'<video src="{src}" controls preload="none"></video>'
+    if ext in AUDIO_EXTENSIONS:
+        return f'<audio src="{src}" controls preload="none"></audio>'
+    return f'<a href="{src}">{html.escape(os.path.basename(arcname))}</a>'
+
+
+def format_log_entry_html(log_entry, media):
+    dt_object = datetime.fromtimestamp(log_entry['timestamp_unix'], tz=timezone.utc)
+    user_info = log_entry['user']
+    author = ' '.join(part for part in (user_info['first_name'], user_info.get('last_name')) if part)
+    if user_info.get('username'):
+        author += f" (@{user_info['username']})"
+    status = " · изменено" if log_entry.get('edited') else ""
+    lines = [f'<div class="message" id="m{log_entry["message_id"]}">',
+             f'<div class="meta">{dt_object.strftime("%Y-%m-%d %H:%M:%S")} · {html.escape(author)} · '
+             f'#{log_entry["message_id"]} · {html.escape(log_entry["content_type"])}{status}</div>']
+    for key in ('text', 'caption'):
+        if log_entry.get(key):
+            lines.append(f"<p>{html.escape(log_entry[key]).replace(chr(10), '<br>')}</p>")
+    if log_entry.get('sticker_emoji'):
+        lines.append(f"<p>{html.escape(log_entry['sticker_emoji'])}</p>")
+    if log_entry.get('location'):
+        loc = log_entry['location']
+        lines.append(f"<p>Локация: {loc['latitude']}, {loc['longitude']}</p>")
+    if log_entry.get('contact_details'):
+        contact = log_entry['contact_details']
+        name = ' '.join(part for part in (contact['first_name'], contact.get('last_name')) if part)
+        lines.append(f"<p>Контакт: {html.escape(name)}, {html.escape(str(contact['phone_number']))}</p>")
+    if log_entry.get('poll_details'):
+        poll = log_entry['poll_details']
+        options = ''.join(f"<li>{html.escape(option)}</li>" for option in poll.get('options') or ())
+        lines.append(f"<p>Опрос: {html.escape(poll['question'])}</p><ol>{options}</ol>")
+    if media:
+        lines.append('<div class="media">' + ''.join(media_tag(arcname) for arcname in media) + '</div>')
+    lines.append('</div>')
+    return '\n'.join(lines) + '\n'
+
+
+class ExportIndex:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=OFF")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.execute("CREATE TABLE messages (message_id INTEGER PRIMARY KEY)")
+        self.conn.execute(
+            "CREATE TABLE media (message_id INTEGER NOT NULL, path TEXT NOT NULL, arcname TEXT NOT NULL, "
+            "PRIMARY KEY (message_id, path))")
+
+    def add_message(self, message_id):
+        self.conn.execute("INSERT OR IGNORE INTO messages (message_id) VALUES (?)", (message_id,))
+
+    def add_media(self, message_id, path):
+        self.conn.execute("INSERT OR IGNORE INTO media (message_id, path, arcname) VALUES (?, ?, ?)",
+                          (message_id, path, 'media/' + os.path.basename(path)))
+
+    def has_message(self, message_id):
+        return self.conn.execute(
+            "SELECT 1 FROM messages WHERE message_id = ?", (message_id,)).fetchone() is not None
+
+    def message_media(self, message_id):
+        return [row[0] for row in self.conn.execute(
+            "SELECT arcname FROM media WHERE message_id = ? ORDER BY rowid", (message_id,))]
+
+    def exported_media(self):
+        return self.conn.execute(
+            "SELECT path, MIN(arcname) FROM media WHERE message_id IN (SELECT message_id FROM messages) "
+            "GROUP BY path ORDER BY MIN(rowid)")
+
+    def close(self):
+        self.conn.close()
+
+
+def render_documents(chat_dir, index, work_dir, formats, since, until, title, reporter):
+    outputs = {fmt: open(os.path.join(work_dir, EXPORT_FILES[fmt]), 'w', encoding='utf-8') for fmt in formats}
+    try:
+        if 'html' in outputs:
+            outputs['html'].write(HTML_HEADER.format(title=html.escape(title)))
+        if 'json' in outputs:
+            outputs['json'].write('[\n')
+        exported = 0
+        first_json = True
+        for log_entry in iter_chat_entries(chat_dir):
+            if log_entry.get('download_update'):
+                if not index.has_message(log_entry['message_id']):
+                    continue
+            elif not in_range(log_entry, since, until):
+                continue
+            else:
+                exported += 1
+                if 'html' in outputs:
+                    media = [] if log_entry.get('edited') else index.message_media(log_entry['message_id'])
+                    outputs['html'].write(format_log_entry_html(log_entry, media))
+            if 'text' in outputs:
+                outputs['text'].write(format_log_entry_human_readable(log_entry))
+            if 'json' in outputs:
+                if not first_json:
+                    outputs['json'].write(',\n')
+                first_json = False
+                outputs['json'].write(json.dumps(log_entry, ensure_ascii=False))
+            reporter.update(messages=exported)
+        if 'html' in outputs:
+            outputs['html'].write(HTML_FOOTER)
+        if 'json' in outputs:
+            outputs['json'].write('\n]\n')
+    finally:
+        for output in outputs.values():
+            output.close()
+    return exported
+
+
+def export_chat(chat_id, output_path, since=None, until=None, formats=EXPORT_FORMATS,
+                root_dir=STRUCTURED_ARCHIVE_DIR, logs_dir=LOGS_DIR, progress=None):
+    chat_dir = os.path.join(root_dir, str(chat_id))
+    reporter = ProgressReporter(progress)
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    part_path = output_path + '.part'
+    with tempfile.TemporaryDirectory(prefix='export_', dir=os.path.dirname(output_path) or '.') as work_dir:
+        writer = open_export_writer(output_path, part_path)
+        try:
+            if list_segments(chat_dir):
+                export_structured(chat_dir, writer, work_dir, formats, since, until, chat_id, reporter)
+            else:
+                export_text_logs(os.path.join(logs_dir, str(chat_id)), writer, since, until, reporter)
+        finally:
+            writer.close()
+    os.replace(part_path, output_path)
+    reporter.update(force=True, stage='done', output_bytes=os.path.getsize(output_path))
+    return reporter.progress
+
+
+def export_structured(chat_dir, writer, work_dir, formats, since, until, chat_id, reporter):
+    index = ExportIndex(os.path.join(work_dir, 'index.sqlite3'))
+    try:
+        messages_total = 0
+        title = f"Чат {chat_id}"
+        for log_entry in iter_chat_entries(chat_dir):
+            if log_entry.get('download_update'):
+                for path in entry_media_paths(log_entry):
+                    index.add_media(log_entry['message_id'], path)
+            elif in_range(log_entry, since, until):
+                if not log_entry.get('edited'):
+                    index.add_message(log_entry['message_id'])
+                messages_total += 1
+                title = log_entry['chat'].get('title') or title
+                reporter.update(messages_total=messages_total)
+        index.conn.commit()
+
+        media_total = 0
+        for path, _ in index.exported_media():
+            if os.path.exists(path):
+                media_total += os.path.getsize(path)
+        reporter.update(force=True, stage='messages', messages_total=messages_total,
+                        media_bytes_total=media_total)
+
+        render_documents(chat_dir, index, work_dir, formats, since, until, title, reporter)
+        for fmt in formats:
+            writer.add_file(os.path.join(work_dir, EXPORT_FILES[fmt]), EXPORT_FILES[fmt])
+
+        reporter.update(force=True, stage='media')
+        media_bytes = 0
+        for path, arcname in index.exported_media():
+            if not os.path.exists(path):
+                logger.warning(f"Медиафайл {path} не найден, пропущен при экспорте")
+                continue
+            writer.add_file(path, arcname, compress=False)
+            media_bytes += os.path.getsize(path)
+            reporter.update(media_bytes=media_bytes)
+    finally:
+        index.close()
+
+
+def export_text_logs(logs_chat_dir, writer, since, until, reporter):
+    paths = [path for path in manifest_segments(logs_chat_dir, since, until) if os.path.exists(path)]
+    total = sum(os.path.getsize(path) for path in paths)
+    reporter.update(force=True, stage='media', media_bytes_total=total)
+    done = 0
+    for path in paths:
+        writer.add_file(path, 'logs/' + os.path.basename(path))
+        done += os.path.getsize(path)
+        reporter.update(media_bytes=done)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Экспорт сообщений и медиафайлов чата в один архив (zip, tar.gz или tar.zst).")
+    parser.add_argument('chat_id', help="ID чата")
+    parser.add_argument('-o', '--output',
+                        help=f"файл архива (по умолчанию {EXPORT_DIR}/chat_<id>_<время>.{EXPORT_CONTAINER})")
+    parser.add_argument('--since', help="начало периода (YYYY-MM-DD или unix time)")
+    parser.add_argument('--until', help="конец периода включительно (YYYY-MM-DD или unix time)")
+    parser.add_argument('--format', default=','.join(EXPORT_FORMATS),
+                        help="форматы сообщений через запятую: html, json, text")
+    parser.add_argument('--root', default=STRUCTURED_ARCHIVE_DIR,
+                        help="папка структурированного архива")
+    parser.add_argument('--logs', default=LOGS_DIR,
+                        help="папка текстовых логов (используется, если структурированного архива нет)")
+    parser.add_argument('--progress', choices=('text', 'json'), default='text',
+                        help="формат отчета о ходе экспорта")
+    parser.add_argument('--nice', type=int, default=0,
+                        help="понизить приоритет процесса на это значение")
+    args = parser.parse_args(argv)
+
+    formats = [fmt for fmt in args.format.split(',') if fmt]
+    for fmt in formats:
+        if fmt not in EXPORT_FORMATS:
+            parser.error(f"неизвестный формат: {fmt}")
+    if args.nice and hasattr(os, 'nice'):
+        os.nice(args.nice)
+
+    if args.progress == 'json':
+        def report(progress):
+            print(json.dumps(progress), flush=True)
+    else:
+        def report(progress):
+            print(format_progress(progress), file=sys.stderr, flush=True)
+
+    output = args.output or default_export_path(args.chat_id)
+    export_chat(args.chat_id, output, since=parse_time(args.since), until=parse_time(args.until, end_of_day=True),
+                formats=formats, root_dir=args.root, logs_dir=args.logs, progress=report)
+    print(f"Экспорт сохранен в {output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+
+JOURNAL_ENABLED = os.getenv('ARCHIVER_JOURNAL', '1') == '1'
+JOURNAL_DIR = os.getenv('ARCHIVER_JOURNAL_DIR', 'journal')
+JOURNAL_COMMIT_INTERVAL = float(os.getenv('ARCHIVER_JOURNAL_COMMIT_INTERVAL', '0.002'))
+JOURNAL_CHECKPOINT_INTERVAL = float(os.getenv('ARCHIVER_JOURNAL_CHECKPOINT_INTERVAL', '5'))
+JOURNAL_SEGMENT_BYTES = int(os.getenv('ARCHIVER_JOURNAL_SEGMENT_BYTES', str(16 * 1024 * 1024)))
+JOURNAL_SEGMENT_RE = re.compile(r'^journal_(\d+)\.log$')
+CHECKPOINT_NAME = 'checkpoint.json'
+UPDATE_KINDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+
+logger = logging.getLogger('TeleBot')
+
+
+def update_to_json(update):
+    data = {'update_id': update.update_id}
+    for kind in UPDATE_KINDS:
+        message = getattr(update, kind, None)
+        if message is not None:
+            data[kind] = message.json
+    return data
+
+
+def list_journal_segments(journal_dir):
+    segments = []
+    try:
+        names = os.listdir(journal_dir)
+    except FileNotFoundError:
+        return segments
+    for name in names:
+        match = JOURNAL_SEGMENT_RE.match(name)
+        if match:
+            segments.append((int(match.group(1)), os.path.join(journal_dir, name)))
+    segments.sort()
+    return segments
+
+
+def read_journal_segment(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logger.warning(f"Поврежденная запись в журнале {path} пропущена")
+
+
+class UpdateJournal:
+    def __init__(self, journal_dir, commit_interval, checkpoint_interval, segment_bytes,
+                 settle_delay, flush_logs):
+        self.journal_dir = journal_dir
+        self.commit_interval = commit_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.segment_bytes = segment_bytes
+        self.settle_delay = settle_delay
+        self.flush_logs = flush_logs
+        self.cond = threading.Condition()
+        self.buffer = []
+        self.write_seq = 0
+        self.synced_seq = 0
+        self.failed_seq = 0
+        self.error = None
+        self.file = None
+        self.segment = 0
+        self.pending = {}
+        self.segment_pending = {}
+        self.finished = []
+        self.last_update_id = -1
+        self.stopping = False
+        self.thread = None
+        self.commits = 0
+        self.journaled = 0
+
+    def _segment_path(self, segment):
+        return os.path.join(self.journal_dir, f"journal_{segment:06d}.log")
+
+    def _load_checkpoint(self):
+        try:
+            with open(os.path.join(self.journal_dir, CHECKPOINT_NAME), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_checkpoint(self):
+        path = os.path.join(self.journal_dir, CHECKPOINT_NAME)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'last_update_id': self.last_update_id}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def open(self):
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self.last_update_id = self._load_checkpoint().get('last_update_id', -1)
+        started = {}
+        done = set()
+        segments = list_journal_segments(self.journal_dir)
+        for segment, path in segments:
+            for record in read_journal_segment(path):
+                if 'done' in record:
+                    done.update(record['done'])
+                else:
+                    update_id = record['update']['update_id']
+                    started[update_id] = (segment, record['update'])
+                    self.last_update_id = max(self.last_update_id, update_id)
+        unfinished = []
+        for update_id in sorted(set(started) - done):
+            segment, data = started[update_id]
+            self.pending[update_id] = segment
+            self.segment_pending[segment] = self.segment_pending.get(segment, 0) + 1
+            unfinished.append(data)
+        for segment, _ in segments:
+            self.segment_pending.setdefault(segment, 0)
+
+        self.segment = segments[-1][0] + 1 if segments else 1
+        self._open_segment()
+        self.thread = threading.Thread(target=self._run, name="update-journal", daemon=True)
+        self.thread.start()
+        if unfinished:
+            logger.warning(
+                f"Журнал обновлений: найдено необработанных обновлений: {len(unfinished)}, они будут обработаны повторно")
+        return unfinished
+
+    def append(self, updates):
+        if not updates:
+            return
+        with self.cond:
+            for update in updates:
+                data = update_to_json(update)
+                self.buffer.append((update.update_id, json.dumps(
+                    {'update': data}, ensure_ascii=False, separators=(',', ':')) + '\n'))
+            self.write_seq += 1
+            seq = self.write_seq
+            self.cond.notify_all()
+            while self.synced_seq < seq and self.failed_seq < seq and not self.stopping:
+                self.cond.wait()
+            if self.synced_seq < seq:
+                raise IOError(f"Updates were not written to the journal: {self.error or 'journal is closed'}")
+        self.journaled += len(updates)
+
+    def finish(self, update_id):
+        with self.cond:
+            self.finished.append((time.monotonic(), update_id))
+
+    def _open_segment(self):
+        self.segment_pending.setdefault(self.segment, 0)
+        self.file = open(self._segment_path(self.segment), 'ab', buffering=0)
+
+    def _write(self, text):
+        if self.file.closed:
+            self._open_segment()
+        position = self.file.seek(0, os.SEEK_END)
+        try:
+            data = memoryview(text.encode('utf-8'))
+            while data:
+                data = data[self.file.write(data):]
+            os.fsync(self.file.fileno())
+        except OSError:
+            try:
+                os.ftruncate(self.file.fileno(), position)
+            except OSError:
+                self.file.close()
+                self.segment += 1
+                self._open_segment()
+            raise
+
+    def _commit(self):
+        with self.cond:
+            if not self.buffer:
+                return
+            records = self.buffer
+            self.buffer = []
+            seq = self.write_seq
+        try:
+            self._write(''.join(line for _, line in records))
+        except OSError as e:
+            logger.error(f"Не удалось записать {len(records)} обновлений в журнал: {e}", exc_info=True)
+            with self.cond:
+                self.error = e
+                self.failed_seq = seq
+                self.cond.notify_all()
+            return
+        self.commits += 1
+        with self.cond:
+            for update_id, _ in records:
+                self.pending[update_id] = self.segment
+                self.last_update_id = max(self.last_update_id, update_id)
+            self.segment_pending[self.segment] += len(records)
+            self.synced_seq = seq
+            self.cond.notify_all()
+            if self.file.tell() >= self.segment_bytes:
+                self.file.close()
+                self.segment += 1
+                self._open_segment()
+
+    def checkpoint(self, settle_delay=None):
+        settle_delay = self.settle_delay if settle_delay is None else settle_delay
+        settled_before = time.monotonic() - settle_delay
+        with self.cond:
+            done = [update_id for finished_at, update_id in self.finished if finished_at <= settled_before]
+            self.finished = [item for item in self.finished if item[0] > settled_before]
+        if done:
+            try:
+                self.flush_logs()
+                self._write(json.dumps({'done': done}, separators=(',', ':')) + '\n')
+            except Exception:
+                with self.cond:
+                    self.finished[:0] = [(settled_before, update_id) for update_id in done]
+                raise
+        with self.cond:
+            for update_id in done:
+                segment = self.pending.pop(update_id, None)
+                if segment is not None:
+                    self.segment_pending[segment] -= 1
+            removable = []
+            for segment in sorted(self.segment_pending):
+                if segment == self.segment or self.segment_pending[segment] > 0:
+                    break
+                removable.append(segment)
+            for segment in removable:
+                del self.segment_pending[segment]
+            last_update_id = self.last_update_id
+        for segment in removable:
+            try:
+                os.remove(self._segment_path(segment))
+            except FileNotFoundError:
+                pass
+        if done or removable:
+            self._save_checkpoint()
+        return last_update_id
+
+    def _run(self):
+        next_checkpoint = time.monotonic() + self.checkpoint_interval
+        while True:
+            with self.cond:
+                if not self.buffer and not self.stopping:
+                    self.cond.wait(max(0.0, next_checkpoint - time.monotonic()))
+                stopping = self.stopping
+                has_records = bool(self.buffer)
+            try:
+                if has_records:
+                    if self.commit_interval > 0:
+                        time.sleep(self.commit_interval)
+                    self._commit()
+                if stopping:
+                    return
+                if time.monotonic() >= next_checkpoint:
+                    self.checkpoint()
+                    next_checkpoint = time.monotonic() + self.checkpoint_interval
+            except Exception as e:
+                logger.error(f"Ошибка записи журнала обновлений: {e}", exc_info=True)
+                time.sleep(1)
+
+    def stats(self):
+        with self.cond:
+            return {'journaled': self.journaled, 'commits': self.commits,
+                    'pending': len(self.pending) + len(self.buffer), 'segments': len(self.segment_pending)}
+
+    def close(self):
+        if self.thread is None:
+            return
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.thread = None
+        self._commit()
+        self.checkpoint(settle_delay=0)
+        self.file.close()
+        self.file = None
@@ -0,0 +1,683 @@
+import contextlib
+import json
+import logging
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from archive_api import backoff_delay
+
+
+MEDIA_ARCHIVE_DIR = 'media_archive'
+DOWNLOAD_WORKERS = int(os.getenv('ARCHIVER_DOWNLOAD_WORKERS', '4'))
+DOWNLOAD_QUEUE_SIZE = int(os.getenv('ARCHIVER_DOWNLOAD_QUEUE_SIZE', '1000'))
+PARTIAL_FILE_SUFFIX = '.part'
+PARTIAL_FILE_MAX_AGE = 24 * 60 * 60
+DEDUP_BLOB_DIR = os.path.join(MEDIA_ARCHIVE_DIR, '_blobs')
+DEDUP_DB_PATH = os.path.join(MEDIA_ARCHIVE_DIR, 'dedup_index.sqlite3')
+DEDUP_CACHE_SIZE = int(os.getenv('ARCHIVER_DEDUP_CACHE_SIZE', '10000'))
+DOWNLOAD_RETRY_DB_PATH = os.path.join(MEDIA_ARCHIVE_DIR, 'download_retries.sqlite3')
+DOWNLOAD_RETRY_ATTEMPTS = int(os.getenv('ARCHIVER_DOWNLOAD_RETRY_ATTEMPTS', '5'))
+DOWNLOAD_RETRY_DELAY = float(os.getenv('ARCHIVER_DOWNLOAD_RETRY_DELAY', '60'))
+DOWNLOAD_RETRY_MAX_DELAY = 6 * 60 * 60
+DOWNLOAD_RETRY_POLL_INTERVAL = 5.0
+STORAGE_DB_PATH = os.path.join(MEDIA_ARCHIVE_DIR, 'storage_usage.sqlite3')
+CHAT_MEDIA_MAX_BYTES = int(os.getenv('ARCHIVER_CHAT_MEDIA_MAX_BYTES', '0'))
+MEDIA_MAX_BYTES = int(os.getenv('ARCHIVER_MEDIA_MAX_BYTES', '0'))
+MEDIA_SKIP_LARGER = os.getenv('ARCHIVER_MEDIA_SKIP_LARGER', '')
+MEDIA_MAX_AGE = float(os.getenv('ARCHIVER_MEDIA_MAX_AGE', '0'))
+MEDIA_COLD_DIR = os.getenv('ARCHIVER_MEDIA_COLD_DIR', '')
+MEDIA_RETENTION_INTERVAL = float(os.getenv('ARCHIVER_MEDIA_RETENTION_INTERVAL', '3600'))
+MEDIA_GROUP_CONCURRENCY = int(os.getenv('ARCHIVER_MEDIA_GROUP_CONCURRENCY', '4'))
+
+logger = logging.getLogger('TeleBot')
+
+
+def remove_stale_partials(root_dir, max_age):
+    removed = 0
+    cutoff = time.time() - max_age
+    for dirpath, _, filenames in os.walk(root_dir):
+        for name in filenames:
+            if not name.endswith(PARTIAL_FILE_SUFFIX):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError as e:
+                logger.warning(f"Не удалось удалить недокачанный файл {path}: {e}")
+    return removed
+
+
+class MediaDedupIndex:
+    def __init__(self, db_path, blob_dir, cache_size):
+        self.db_path = db_path
+        self.blob_dir = blob_dir
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.conn = None
+        self.lock = threading.Lock()
+        self.file_locks = {}
+        self.file_locks_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.content_hits = 0
+        self.bytes_saved = 0
+
+    def _connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS media_blobs ("
+                "file_unique_id TEXT PRIMARY KEY, blob_path TEXT NOT NULL, "
+                "size INTEGER NOT NULL, sha256 TEXT)")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS media_blobs_sha256 ON media_blobs (sha256)")
+            self.conn.commit()
+        return self.conn
+
+    def _remember(self, file_unique_id, record):
+        self.cache[file_unique_id] = record
+        self.cache.move_to_end(file_unique_id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    @contextlib.contextmanager
+    def file_lock(self, file_unique_id):
+        with self.file_locks_lock:
+            entry = self.file_locks.get(file_unique_id)
+            if entry is None:
+                entry = self.file_locks[file_unique_id] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.file_locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.file_locks[file_unique_id]
+
+    def blob_path_for(self, file_unique_id, file_ext):
+        return os.path.join(self.blob_dir, file_unique_id[:2], f"{file_unique_id}{file_ext}")
+
+    def _find(self, file_unique_id):
+        record = self.cache.get(file_unique_id)
+        if record is not None:
+            self.cache.move_to_end(file_unique_id)
+        else:
+            row = self._connect().execute(
+                "SELECT blob_path, size, sha256 FROM media_blobs WHERE file_unique_id = ?",
+                (file_unique_id,)).fetchone()
+            if row:
+                record = {'blob_path': row[0],
+                          'size': row[1], 'sha256': row[2]}
+                self._remember(file_unique_id, record)
+        if record is not None and not os.path.exists(record['blob_path']):
+            self.cache.pop(file_unique_id, None)
+            record = None
+        return record
+
+    def lookup(self, file_unique_id):
+        with self.lock:
+            record = self._find(file_unique_id)
+            if record is not None:
+                self.hits += 1
+                self.bytes_saved += record['size']
+            else:
+                self.misses += 1
+            return record
+
+    def contains(self, file_unique_id):
+        with self.lock:
+            return self._find(file_unique_id) is not None
+
+    def unknown(self, file_unique_ids, batch_size=500):
+        unknown = set(file_unique_ids)
+        ids = list(unknown)
+        with self.lock:
+            conn = self._connect()
+            for start in range(0, len(ids), batch_size):
+                batch = ids[start:start + batch_size]
+                unknown.difference_update(row[0] for row in conn.execute(
+                    f"SELECT file_unique_id FROM media_blobs WHERE file_unique_id IN ({','.join('?' * len(batch))})",
+                    batch))
+        return unknown
+
+    def add(self, file_unique_id, blob_path, size, sha256=None):
+        with self.lock:
+            conn = self._connect()
+            if sha256:
+                row = conn.execute(
+                    "SELECT blob_path FROM media_blobs WHERE sha256 = ? AND blob_path != ? LIMIT 1",
+                    (sha256, blob_path)).fetchone()
+                if row and os.path.exists(row[0]):
+                    os.remove(blob_path)
+                    blob_path = row[0]
+                    self.content_hits += 1
+                    self.bytes_saved += size
+            conn.execute(
+                "INSERT OR REPLACE INTO media_blobs (file_unique_id, blob_path, size, sha256) VALUES (?, ?, ?, ?)",
+                (file_unique_id, blob_path, size, sha256))
+            conn.commit()
+            record = {'blob_path': blob_path, 'size': size, 'sha256': sha256}
+            self._remember(file_unique_id, record)
+            return record
+
+    def owns(self, path):
+        blob_dir = os.path.abspath(self.blob_dir)
+        return os.path.commonpath([os.path.abspath(path), blob_dir]) == blob_dir
+
+    def total_size(self):
+        with self.lock:
+            row = self._connect().execute(
+                "SELECT SUM(size) FROM (SELECT DISTINCT blob_path, size FROM media_blobs)").fetchone()
+            return row[0] or 0
+
+    def remove(self, file_unique_id):
+        with self.lock:
+            conn = self._connect()
+            self.cache.pop(file_unique_id, None)
+            row = conn.execute(
+                "SELECT blob_path, size FROM media_blobs WHERE file_unique_id = ?", (file_unique_id,)).fetchone()
+            if row is None:
+                return 0
+            conn.execute("DELETE FROM media_blobs WHERE file_unique_id = ?", (file_unique_id,))
+            shared = conn.execute(
+                "SELECT 1 FROM media_blobs WHERE blob_path = ? LIMIT 1", (row[0],)).fetchone()
+            conn.commit()
+        if shared:
+            return 0
+        try:
+            os.remove(row[0])
+        except FileNotFoundError:
+            pass
+        return row[1]
+
+    def link_into(self, blob_path, save_path):
+        if os.path.exists(save_path):
+            return save_path
+        try:
+            os.link(blob_path, save_path)
+            return save_path
+        except OSError as e:
+            logger.debug(
+                f"Не удалось создать жесткую ссылку {save_path} -> {blob_path}: {e}")
+            return blob_path
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'content_hits': self.content_hits, 'bytes_saved': self.bytes_saved}
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+def parse_size_limits(spec):
+    limits = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        content_type, _, size = item.partition('=')
+        limits[content_type.strip()] = int(size)
+    return limits
+
+
+class MediaStorage:
+    def __init__(self, db_path, dedup, chat_max_bytes, total_max_bytes, skip_larger, max_age, cold_dir,
+                 retention_interval):
+        self.db_path = db_path
+        self.dedup = dedup
+        self.chat_max_bytes = chat_max_bytes
+        self.total_max_bytes = total_max_bytes
+        self.skip_larger = skip_larger
+        self.max_age = max_age
+        self.cold_dir = cold_dir
+        self.retention_interval = retention_interval
+        self.conn = None
+        self.lock = threading.Lock()
+        self.chats = {}
+        self.total_bytes = 0
+        self.reserved = {}
+        self.chat_reserved = {}
+        self.total_reserved = 0
+        self.skipped = {'size': 0, 'chat_quota': 0, 'total_quota': 0}
+        self.expired = {'deleted': 0, 'moved': 0}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS media_files ("
+                "chat_id INTEGER NOT NULL, file_unique_id TEXT NOT NULL, path TEXT NOT NULL, "
+                "size INTEGER NOT NULL, content_type TEXT, added REAL NOT NULL, cold INTEGER NOT NULL DEFAULT 0, "
+                "PRIMARY KEY (chat_id, file_unique_id))")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS media_files_unique_id ON media_files (file_unique_id)")
+            self.conn.commit()
+        return self.conn
+
+    def _usage(self, chat_id):
+        usage = self.chats.get(chat_id)
+        if usage is None:
+            usage = self.chats[chat_id] = {'bytes': 0, 'files': 0, 'cold_bytes': 0, 'cold_files': 0}
+        return usage
+
+    def _backfill(self, conn, media_root):
+        rows = []
+        for name in os.listdir(media_root):
+            chat_dir = os.path.join(media_root, name)
+            try:
+                chat_id = int(name)
+            except ValueError:
+                continue
+            if not os.path.isdir(chat_dir):
+                continue
+            for file_name in os.listdir(chat_dir):
+                if file_name.endswith(PARTIAL_FILE_SUFFIX):
+                    continue
+                path = os.path.join(chat_dir, file_name)
+                stat = os.stat(path)
+                rows.append((chat_id, os.path.splitext(file_name)[0], path, stat.st_size, stat.st_mtime))
+        conn.executemany(
+            "INSERT OR IGNORE INTO media_files (chat_id, file_unique_id, path, size, added) VALUES (?, ?, ?, ?, ?)",
+            rows)
+        conn.commit()
+        if rows:
+            logger.info(f"Учет места: найдено ранее скачанных файлов медиа: {len(rows)}")
+
+    def open(self, media_root):
+        with self.lock:
+            conn = self._connect()
+            if conn.execute("SELECT 1 FROM media_files LIMIT 1").fetchone() is None and os.path.isdir(media_root):
+                self._backfill(conn, media_root)
+            self.chats = {}
+            for chat_id, cold, size, files in conn.execute(
+                    "SELECT chat_id, cold, SUM(size), COUNT(*) FROM media_files GROUP BY chat_id, cold"):
+                usage = self._usage(chat_id)
+                usage['cold_bytes' if cold else 'bytes'] += size
+                usage['cold_files' if cold else 'files'] += files
+            rows = conn.execute("SELECT file_unique_id, size FROM media_files WHERE cold = 0").fetchall()
+        unknown = self.dedup.unknown(file_unique_id for file_unique_id, _ in rows)
+        self.total_bytes = self.dedup.total_size() + sum(
+            size for file_unique_id, size in rows if file_unique_id in unknown)
+
+    def check(self, chat_id, content_type, file_unique_id, file_size):
+        size = file_size or 0
+        limit = self.skip_larger.get(content_type)
+        new_size = 0 if size and self.dedup.contains(file_unique_id) else size
+        with self.lock:
+            usage = self.chats.get(chat_id)
+            chat_bytes = (usage['bytes'] if usage is not None else 0) + self.chat_reserved.get(chat_id, 0)
+            total_bytes = self.total_bytes + self.total_reserved
+            if limit is not None and size > limit:
+                reason = 'size'
+                error = f"File is larger than the archiving limit for {content_type} ({size} > {limit} bytes)"
+            elif self.chat_max_bytes > 0 and chat_bytes + size > self.chat_max_bytes:
+                reason = 'chat_quota'
+                error = f"Chat media quota exceeded ({chat_bytes} of {self.chat_max_bytes} bytes used)"
+            elif self.total_max_bytes > 0 and total_bytes + new_size > self.total_max_bytes:
+                reason = 'total_quota'
+                error = f"Media storage quota exceeded ({total_bytes} of {self.total_max_bytes} bytes used)"
+            else:
+                key = (chat_id, file_unique_id)
+                if size and key not in self.reserved:
+                    self.reserved[key] = (size, new_size)
+                    self.chat_reserved[chat_id] = self.chat_reserved.get(chat_id, 0) + size
+                    self.total_reserved += new_size
+                return None
+            self.skipped[reason] += 1
+            return error
+
+    def release(self, chat_id, file_unique_id):
+        with self.lock:
+            reservation = self.reserved.pop((chat_id, file_unique_id), None)
+            if reservation is None:
+                return
+            size, new_size = reservation
+            self.chat_reserved[chat_id] -= size
+            if not self.chat_reserved[chat_id]:
+                del self.chat_reserved[chat_id]
+            self.total_reserved -= new_size
+
+    def record(self, chat_id, file_unique_id, path, size, content_type, new_bytes):
+        try:
+            with self.lock:
+                conn = self._connect()
+                self.total_bytes += new_bytes
+                row = conn.execute(
+                    "SELECT cold FROM media_files WHERE chat_id = ? AND file_unique_id = ?",
+                    (chat_id, file_unique_id)).fetchone()
+                if row is not None and not row[0]:
+                    return
+                usage = self._usage(chat_id)
+                if row is not None:
+                    usage['cold_bytes'] -= size
+                    usage['cold_files'] -= 1
+                conn.execute(
+                    "INSERT OR REPLACE INTO media_files (chat_id, file_unique_id, path, size, content_type, added, cold) "
+                    "VALUES (?, ?, ?, ?, ?, ?, 0)", (chat_id, file_unique_id, path, size, content_type, time.time()))
+                conn.commit()
+                usage['bytes'] += size
+                usage['files'] += 1
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка учета места для файла {file_unique_id} в чате {chat_id}: {e}", exc_info=True)
+
+    def _expire(self, chat_id, file_unique_id, path, size):
+        with self.dedup.file_lock(file_unique_id):
+            legacy = bool(self.dedup.unknown([file_unique_id]))
+            with self.lock:
+                shared = self._connect().execute(
+                    "SELECT 1 FROM media_files WHERE file_unique_id = ? AND chat_id != ? AND cold = 0 LIMIT 1",
+                    (file_unique_id, chat_id)).fetchone() is not None
+            cold_path = None
+            try:
+                if self.cold_dir:
+                    cold_path = os.path.join(self.cold_dir, str(chat_id), os.path.basename(path))
+                    os.makedirs(os.path.dirname(cold_path), exist_ok=True)
+                    if shared and self.dedup.owns(path):
+                        shutil.copy2(path, cold_path)
+                    else:
+                        shutil.move(path, cold_path)
+                elif not self.dedup.owns(path):
+                    os.remove(path)
+            except FileNotFoundError:
+                cold_path = None
+            if legacy:
+                freed = size
+            else:
+                freed = 0 if shared else self.dedup.remove(file_unique_id)
+            with self.lock:
+                conn = self._connect()
+                usage = self._usage(chat_id)
+                usage['bytes'] -= size
+                usage['files'] -= 1
+                if cold_path is not None:
+                    conn.execute(
+                        "UPDATE media_files SET path = ?, cold = 1 WHERE chat_id = ? AND file_unique_id = ?",
+                        (cold_path, chat_id, file_unique_id))
+                    usage['cold_bytes'] += size
+                    usage['cold_files'] += 1
+                    self.expired['moved'] += 1
+                else:
+                    conn.execute("DELETE FROM media_files WHERE chat_id = ? AND file_unique_id = ?",
+                                 (chat_id, file_unique_id))
+                    self.expired['deleted'] += 1
+                conn.commit()
+                self.total_bytes -= freed
+
+    def expire(self, batch_size=500):
+        if self.max_age <= 0:
+            return 0
+        cutoff = time.time() - self.max_age
+        last_rowid = 0
+        expired = 0
+        while not self.stop_event.is_set():
+            with self.lock:
+                rows = self._connect().execute(
+                    "SELECT rowid, chat_id, file_unique_id, path, size FROM media_files "
+                    "WHERE cold = 0 AND added < ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                    (cutoff, last_rowid, batch_size)).fetchall()
+            if not rows:
+                break
+            for rowid, chat_id, file_unique_id, path, size in rows:
+                last_rowid = rowid
+                try:
+                    self._expire(chat_id, file_unique_id, path, size)
+                    expired += 1
+                except OSError as e:
+                    logger.warning(f"Не удалось удалить или перенести устаревший файл {path}: {e}")
+        return expired
+
+    def start(self):
+        if self.max_age > 0 and self.retention_interval > 0:
+            self.thread = threading.Thread(target=self._run, name="media-retention", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while not self.stop_event.wait(self.retention_interval):
+            try:
+                expired = self.expire()
+                if expired:
+                    action = "перенесено в холодное хранилище" if self.cold_dir else "удалено"
+                    logger.info(f"Устаревших файлов медиа {action}: {expired}")
+            except Exception as e:
+                logger.error(f"Ошибка очистки устаревших файлов медиа: {e}", exc_info=True)
+
+    def usage(self, chat_id):
+        with self.lock:
+            usage = self.chats.get(chat_id)
+            return dict(usage) if usage is not None else {'bytes': 0, 'files': 0, 'cold_bytes': 0, 'cold_files': 0}
+
+    def stats(self):
+        with self.lock:
+            return {'total_bytes': self.total_bytes, 'chats': len(self.chats),
+                    'skipped': dict(self.skipped), 'expired': dict(self.expired)}
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+class MediaDownloadPool:
+    def __init__(self, num_workers, queue_size, group_concurrency, download, download_group):
+        self.num_workers = max(1, num_workers)
+        self.queue_size = queue_size
+        self.queues = [queue.Queue(maxsize=queue_size)
+                       for _ in range(self.num_workers)]
+        self.threads = []
+        self.group_concurrency = max(1, group_concurrency)
+        self.group_executor = None
+        self.download = download
+        self.download_group = download_group
+
+    def start(self):
+        self.group_executor = ThreadPoolExecutor(
+            max_workers=self.group_concurrency, thread_name_prefix="media-group-download")
+        for i, q in enumerate(self.queues):
+            thread = threading.Thread(
+                target=self._worker, args=(q,), name=f"media-download-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logger.info(
+            f"Запущено потоков загрузки медиа: {self.num_workers}")
+
+    def _shard(self, chat_id):
+        return zlib.crc32(str(chat_id).encode()) % self.num_workers
+
+    def submit(self, job):
+        try:
+            self.queues[self._shard(job['chat_id'])].put_nowait(job)
+            return True
+        except queue.Full:
+            return False
+
+    def pending(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def is_saturated(self):
+        return any(q.full() for q in self.queues)
+
+    def _worker(self, q):
+        while True:
+            job = q.get()
+            try:
+                if job is None:
+                    return
+                if job['log_entry'].get('media_group'):
+                    self.download_group(job, self.group_executor)
+                else:
+                    self.download(job)
+            except Exception as e:
+                logger.error(
+                    f"Ошибка в потоке загрузки медиа: {e}", exc_info=True)
+            finally:
+                q.task_done()
+
+    def stop(self, timeout=None):
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+        if self.group_executor is not None:
+            self.group_executor.shutdown(wait=True)
+            self.group_executor = None
+
+
+class DownloadRetryQueue:
+    def __init__(self, db_path, max_attempts, base_delay, max_delay, poll_interval, submit):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.submit = submit
+        self.conn = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.scheduled = 0
+        self.resubmitted = 0
+        self.abandoned = 0
+
+    def _connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS download_jobs (id INTEGER PRIMARY KEY, job TEXT NOT NULL)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS download_retries ("
+                "id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, attempts INTEGER NOT NULL, "
+                "next_attempt REAL NOT NULL, job TEXT NOT NULL)")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS download_retries_next_attempt ON download_retries (next_attempt)")
+            self.conn.commit()
+        return self.conn
+
+    def start(self):
+        if self.max_attempts > 0:
+            self.stop_event.clear()
+            self.thread = threading.Thread(
+                target=self._run, name="download-retry", daemon=True)
+            self.thread.start()
+
+    def track(self, job):
+        with self.lock:
+            cursor = self._connect().execute(
+                "INSERT INTO download_jobs (job) VALUES (?)", (json.dumps(job, ensure_ascii=False),))
+            self.conn.commit()
+        job['job_id'] = cursor.lastrowid
+
+    def finish(self, job):
+        job_id = job.pop('job_id', None)
+        if job_id is None:
+            return
+        with self.lock:
+            self._connect().execute("DELETE FROM download_jobs WHERE id = ?", (job_id,))
+            self.conn.commit()
+
+    def recover(self):
+        with self.lock:
+            conn = self._connect()
+            rows = conn.execute("SELECT job FROM download_jobs").fetchall()
+            now = time.time()
+            for (payload,) in rows:
+                job = json.loads(payload)
+                conn.execute(
+                    "INSERT INTO download_retries (chat_id, attempts, next_attempt, job) VALUES (?, ?, ?, ?)",
+                    (job['chat_id'], job.get('retry_attempts', 0), now, payload))
+            conn.execute("DELETE FROM download_jobs")
+            conn.commit()
+        if rows:
+            logger.warning(
+                f"Незавершенных загрузок медиа после перезапуска: {len(rows)}, они будут продолжены.")
+        return len(rows)
+
+    def add(self, job):
+        job = {key: value for key, value in job.items() if key != 'job_id'}
+        attempts = job.get('retry_attempts', 0) + 1
+        message_id = job['log_entry']['message_id']
+        if attempts > self.max_attempts:
+            self.abandoned += 1
+            logger.warning(
+                f"Файл из сообщения {message_id} в чате {job['chat_id']} не скачан после {attempts - 1} повторных попыток.")
+            return False
+        delay = backoff_delay(attempts - 1, self.base_delay, self.max_delay)
+        with self.lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT INTO download_retries (chat_id, attempts, next_attempt, job) VALUES (?, ?, ?, ?)",
+                (job['chat_id'], attempts, time.time() + delay,
+                 json.dumps(dict(job, retry_attempts=attempts), ensure_ascii=False)))
+            conn.commit()
+        self.scheduled += 1
+        logger.info(
+            f"Повторное скачивание файла из сообщения {message_id} в чате {job['chat_id']} через {delay:.0f} с (попытка {attempts} из {self.max_attempts}).")
+        return True
+
+    def resubmit_due(self, limit=100):
+        with self.lock:
+            rows = self._connect().execute(
+                "SELECT id, job FROM download_retries WHERE next_attempt <= ? ORDER BY next_attempt LIMIT ?",
+                (time.time(), limit)).fetchall()
+        for row_id, payload in rows:
+            if not self.submit(json.loads(payload)):
+                break
+            with self.lock:
+                self.conn.execute(
+                    "DELETE FROM download_retries WHERE id = ?", (row_id,))
+                self.conn.commit()
+            self.resubmitted += 1
+
+    def pending(self):
+        with self.lock:
+            return self._connect().execute("SELECT COUNT(*) FROM download_retries").fetchone()[0]
+
+    def _run(self):
+        while not self.stop_event.wait(self.poll_interval):
+            try:
+                self.resubmit_due()
+            except Exception as e:
+                logger.error(
+                    f"Ошибка обработки очереди повторных загрузок: {e}", exc_info=True)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
@@ -0,0 +1,238 @@
+import argparse
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+from datetime import date, datetime, timedelta, timezone
+
+from archive_store import STRUCTURED_ARCHIVE_DIR, iter_chat_entries
+
+
+SEARCH_DB_PATH = os.getenv('ARCHIVER_SEARCH_DB',
+                           os.path.join(STRUCTURED_ARCHIVE_DIR, 'search_index.sqlite3'))
+SEARCH_BATCH_SIZE = int(os.getenv('ARCHIVER_SEARCH_BATCH_SIZE', '500'))
+SEARCH_FLUSH_INTERVAL = float(os.getenv('ARCHIVER_SEARCH_FLUSH_INTERVAL', '1.0'))
+SEARCH_QUEUE_SIZE = 100000
+
+logger = logging.getLogger('TeleBot')
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS messages ("
+    "id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, "
+    "user_id INTEGER, content_type TEXT NOT NULL, timestamp INTEGER NOT NULL, "
+    "edited INTEGER NOT NULL DEFAULT 0)",
+    "CREATE INDEX IF NOT EXISTS messages_chat_time ON messages (chat_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS messages_user_time ON messages (user_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS messages_time ON messages (timestamp)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (text, caption)",
+)
+
+
+def to_fts_query(text):
+    terms = [term.replace('"', '""') for term in text.split()]
+    return ' '.join(f'"{term}"' for term in terms if term)
+
+
+def parse_time(value, end_of_day=False):
+    if value is None:
+        return None
+    if value.isdigit():
+        return int(value)
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    if end_of_day:
+        try:
+            date.fromisoformat(value)
+        except ValueError:
+            pass
+        else:
+            dt += timedelta(days=1, seconds=-1)
+    return int(dt.timestamp())
+
+
+class SearchIndex:
+    def __init__(self, db_path, batch_size=SEARCH_BATCH_SIZE, flush_interval=SEARCH_FLUSH_INTERVAL):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=SEARCH_QUEUE_SIZE)
+        self.thread = None
+        self.dropped = 0
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+        return conn
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._run, name="search-indexer", daemon=True)
+        self.thread.start()
+
+    def add(self, log_entry):
+        if log_entry.get('download_update'):
+            return
+        try:
+            self.queue.put_nowait(log_entry)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(
+                    f"Очередь поискового индекса переполнена, пропущено сообщений: {self.dropped}")
+
+    def index_batch(self, conn, entries):
+        with conn:
+            for log_entry in entries:
+                cursor = conn.execute(
+                    "INSERT INTO messages (chat_id, message_id, user_id, content_type, timestamp, edited) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (log_entry['chat']['id'], log_entry['message_id'],
+                     (log_entry.get('user') or {}).get('id'), log_entry['content_type'],
+                     log_entry['timestamp_unix'], int(bool(log_entry.get('edited')))))
+                conn.execute(
+                    "INSERT INTO messages_fts (rowid, text, caption) VALUES (?, ?, ?)",
+                    (cursor.lastrowid, log_entry.get('text') or '', log_entry.get('caption') or ''))
+
+    def _run(self):
+        conn = self.connect()
+        stopping = False
+        while not stopping:
+            batch = []
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+                while True:
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            if batch:
+                try:
+                    self.index_batch(conn, batch)
+                except Exception as e:
+                    logger.error(
+                        f"Ошибка обновления поискового индекса ({len(batch)} сообщений): {e}", exc_info=True)
+        conn.close()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def search(self, text=None, chat_id=None, user_id=None, content_type=None,
+               since=None, until=None, limit=20):
+        conditions = []
+        params = []
+        if text:
+            conditions.append("messages_fts MATCH ?")
+            params.append(to_fts_query(text))
+        for column, value in (('m.chat_id = ?', chat_id), ('m.user_id = ?', user_id),
+                              ('m.content_type = ?', content_type),
+                              ('m.timestamp >= ?', since), ('m.timestamp <= ?', until)):
+            if value is not None:
+                conditions.append(column)
+                params.append(value)
+        sql = ("SELECT m.chat_id, m.message_id, m.user_id, m.content_type, m.timestamp, m.edited, "
+               "f.text, f.caption FROM messages m JOIN messages_fts f ON f.rowid = m.id")
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY m.timestamp DESC LIMIT ?"
+        params.append(limit)
+
+        conn = self.connect()
+        try:
+            rows = conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+        columns = ('chat_id', 'message_id', 'user_id', 'content_type',
+                   'timestamp', 'edited', 'text', 'caption')
+        return [dict(zip(columns, row)) for row in rows]
+
+
+def format_search_result(result, max_text=200):
+    dt_object = datetime.fromtimestamp(result['timestamp'], tz=timezone.utc)
+    body = result['text'] or result['caption'] or f"[{result['content_type']}]"
+    if len(body) > max_text:
+        body = body[:max_text] + "…"
+    edited = " (изменено)" if result['edited'] else ""
+    return (f"{dt_object.strftime('%Y-%m-%d %H:%M')} чат {result['chat_id']}, "
+            f"сообщение {result['message_id']}, пользователь {result['user_id']}{edited}: {body}")
+
+
+def rebuild(index, root_dir):
+    conn = index.connect()
+    with conn:
+        conn.execute("DELETE FROM messages")
+        conn.execute("DELETE FROM messages_fts")
+    total = 0
+    for name in sorted(os.listdir(root_dir)):
+        chat_dir = os.path.join(root_dir, name)
+        if not os.path.isdir(chat_dir):
+            continue
+        batch = []
+        for log_entry in iter_chat_entries(chat_dir):
+            if log_entry.get('download_update'):
+                continue
+            batch.append(log_entry)
+            if len(batch) >= index.batch_size:
+                index.index_batch(conn, batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            index.index_batch(conn, batch)
+            total += len(batch)
+    conn.close()
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Поиск по архиву сообщений.")
+    parser.add_argument('--db', default=SEARCH_DB_PATH,
+                        help="файл поискового индекса")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    query_parser = subparsers.add_parser('query', help="найти сообщения")
+    query_parser.add_argument('text', nargs='?', help="искомый текст")
+    query_parser.add_argument('--chat', type=int, help="ID чата")
+    query_parser.add_argument('--user', type=int, help="ID пользователя")
+    query_parser.add_argument('--type', dest='content_type',
+                              help="тип сообщения (text, photo, ...)")
+    query_parser.add_argument('--since', help="начало периода (YYYY-MM-DD или unix time)")
+    query_parser.add_argument('--until', help="конец периода включительно (YYYY-MM-DD или unix time)")
+    query_parser.add_argument('--limit', type=int, default=20)
+
+    rebuild_parser = subparsers.add_parser(
+        'rebuild', help="пересоздать индекс из структурированного архива")
+    rebuild_parser.add_argument('--root', default=STRUCTURED_ARCHIVE_DIR,
+                                help="папка структурированного архива")
+    args = parser.parse_args(argv)
+
+    index = SearchIndex(args.db)
+    if args.command == 'rebuild':
+        total = rebuild(index, args.root)
+        print(f"Проиндексировано сообщений: {total}", file=sys.stderr)
+        return
+    results = index.search(args.text, chat_id=args.chat, user_id=args.user,
+                           content_type=args.content_type, since=parse_time(args.since),
+                           until=parse_time(args.until, end_of_day=True), limit=args.limit)
+    for result in results:
+        print(format_search_result(result, max_text=1000))
+    print(f"Найдено: {len(results)}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,858 @@
+import argparse
+import difflib
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+STRUCTURED_ARCHIVE_DIR = os.getenv('ARCHIVER_STRUCTURED_DIR', 'archive')
+SEGMENT_MAX_BYTES = int(os.getenv('ARCHIVER_SEGMENT_MAX_BYTES', str(64 * 1024 * 1024)))
+SEGMENT_COMPRESSION = os.getenv('ARCHIVER_SEGMENT_COMPRESSION', 'gzip')
+SEGMENT_PREFIX = 'segment_'
+SEGMENT_EXTENSION = '.jsonl'
+COMPRESSED_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+SEGMENT_RE = re.compile(r'^segment_(\d+)\.jsonl(\.gz|\.zst)?$')
+COMPACTED_MARKER = 'compacted.json'
+LOGS_DIR = os.getenv('ARCHIVER_LOGS_DIR', 'logs')
+LOG_ROTATE_BYTES = int(os.getenv('ARCHIVER_LOG_ROTATE_BYTES', str(64 * 1024 * 1024)))
+LOG_ROTATE_INTERVAL = int(os.getenv('ARCHIVER_LOG_ROTATE_INTERVAL', str(24 * 60 * 60)))
+MANIFEST_NAME = 'manifest.json'
+
+CONTENT_TYPES_WITH_FILES = ['audio', 'document',
+                            'photo', 'video', 'video_note', 'voice', 'sticker']
+
+logger = logging.getLogger('TeleBot')
+
+
+def format_media_group_items(items):
+    lines = [f"Файлы альбома ({len(items)}):"]
+    for i, item in enumerate(items):
+        item_desc = f"  {i + 1}. {item['content_type']} (ID: {item['message_id']})"
+        if item.get('local_path'):
+            item_desc += f", сохранен как: {item['local_path']}"
+        elif item.get('download_error'):
+            item_desc += f", ошибка скачивания: {item['download_error']}"
+        elif item.get('file_id'):
+            item_desc += f", File ID: {item['file_id']}"
+        lines.append(item_desc)
+    return lines
+
+
+def format_log_entry_human_readable(log_entry):
+    lines = []
+    lines.append("---")
+    timestamp = log_entry['timestamp_unix']
+    dt_object = datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+    if log_entry.get('download_update'):
+        if log_entry.get('media_group'):
+            lines.append(
+                f"Статус: ЗАГРУЗКА АЛЬБОМА ЗАВЕРШЕНА (ID: {log_entry['message_id']})")
+        else:
+            lines.append(
+                f"Статус: ЗАГРУЗКА МЕДИАФАЙЛА ЗАВЕРШЕНА (ID: {log_entry['message_id']})")
+        lines.append(
+            f"Время загрузки: {dt_object.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+        lines.append(f"Чат ID: {log_entry['chat']['id']}")
+        lines.append(f"Тип: {log_entry['content_type']}")
+        if log_entry.get('download_retry'):
+            lines.append(f"Повторная попытка: {log_entry['download_retry']}")
+        if log_entry.get('media_group'):
+            lines.extend(format_media_group_items(log_entry['media_group']))
+        if log_entry.get('file_name'):
+            lines.append(f"Имя файла: {log_entry['file_name']}")
+        if log_entry.get('local_path'):
+            lines.append(f"Сохранен как: {log_entry['local_path']}")
+        elif log_entry.get('download_error'):
+            lines.append(f"Ошибка скачивания: {log_entry['download_error']}")
+        lines.append("---")
+        lines.append("")
+        return "\n".join(lines)
+
+    if log_entry.get('edited'):
+        lines.append(
+            f"Статус: СООБЩЕНИЕ ИЗМЕНЕНО (ID: {log_entry['message_id']})")
+        lines.append(
+            f"Время изменения: {dt_object.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+        if log_entry.get('edit_count', 1) > 1:
+            lines.append(f"Изменений подряд: {log_entry['edit_count']}")
+    else:
+        lines.append(f"Время: {dt_object.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+
+        lines.append(f"ID Сообщения: {log_entry['message_id']}")
+
+    chat_info = log_entry['chat']
+    user_info = log_entry['user']
+    chat_desc = f"Чат ID: {chat_info['id']} ({chat_info['type']})"
+    if chat_info.get('title'):
+        chat_desc = f"Чат: {chat_info['title']} (ID: {chat_info['id']})"
+    elif chat_info.get('username'):
+        chat_desc += f" @{chat_info['username']}"
+    lines.append(chat_desc)
+
+    user_desc = f"От: {user_info['first_name']}"
+    if user_info.get('last_name'):
+        user_desc += f" {user_info['last_name']}"
+    if user_info.get('username'):
+        user_desc += f" (@{user_info['username']})"
+    user_desc += f" (ID: {user_info['id']})"
+    if user_info.get('is_bot'):
+        user_desc += " [БОТ]"
+    lines.append(user_desc)
+
+    lines.append(f"Тип: {log_entry['content_type']}")
+
+    if log_entry.get('text'):
+        lines.append(f"Текст: {log_entry['text']}")
+    if log_entry.get('caption'):
+        lines.append(f"Подпись: {log_entry['caption']}")
+
+    if log_entry.get('contact_details'):
+        contact = log_entry['contact_details']
+        contact_name = contact['first_name']
+        if contact.get('last_name'):
+            contact_name += f" {contact['last_name']}"
+        lines.append(f"Контакт: {contact_name}")
+        lines.append(f"Номер телефона: {contact['phone_number']}")
+        if contact.get('user_id'):
+            lines.append(f"Telegram ID: {contact['user_id']}")
+
+    if log_entry.get('poll_details'):
+        poll = log_entry['poll_details']
+        lines.append(f"Опрос: {poll['question']}")
+        if poll.get('options'):
+            lines.append("Варианты:")
+            for i, option in enumerate(poll['options']):
+                lines.append(f"  {i + 1}. {option}")
+
+    if not log_entry.get('edited') and log_entry['content_type'] in CONTENT_TYPES_WITH_FILES:
+        if log_entry.get('file_name'):
+            lines.append(f"Имя файла: {log_entry['file_name']}")
+        if log_entry.get('local_path'):
+            lines.append(f"Сохранен как: {log_entry['local_path']}")
+        elif log_entry.get('download_error'):
+            lines.append(f"Ошибка скачивания: {log_entry['download_error']}")
+        elif log_entry.get('file_id'):
+            lines.append(f"File ID: {log_entry['file_id']}")
+
+    if not log_entry.get('edited') and log_entry.get('media_group'):
+        lines.extend(format_media_group_items(log_entry['media_group']))
+
+    if log_entry['content_type'] == 'sticker' and log_entry.get('sticker_emoji'):
+
+        lines.append(f"Стикер эмодзи: {log_entry['sticker_emoji']}")
+    if log_entry['content_type'] == 'location' and log_entry.get('location'):
+        loc = log_entry['location']
+        lines.append(f"Локация: lat={loc['latitude']}, lon={loc['longitude']}")
+
+    lines.append("---")
+    lines.append("")
+    return "\n".join(lines)
+
+
+def sync_path(path):
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ChatLogHandle:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.pending_bytes = 0
+        self.unsynced = False
+        self.last_flush = time.monotonic()
+
+    def flush(self, fsync):
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+            self.unsynced = False
+        self.pending_bytes = 0
+        self.last_flush = time.monotonic()
+
+    def close(self, fsync):
+        if self.file is not None:
+            self.flush(fsync)
+            self.file.close()
+            self.file = None
+
+
+class ChatLogWriter:
+    FSYNC_MODES = ('none', 'flush', 'always')
+
+    def __init__(self, max_open, flush_interval, flush_bytes, fsync_mode):
+        if fsync_mode not in self.FSYNC_MODES:
+            raise ValueError(
+                f"fsync_mode must be one of {self.FSYNC_MODES}, got {fsync_mode!r}")
+        self.max_open = max(1, max_open)
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.fsync_mode = fsync_mode
+        self.handles = OrderedDict()
+        self.unsynced_paths = set()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.flusher = None
+
+    def start(self):
+        if self.flush_interval > 0:
+            self.flusher = threading.Thread(
+                target=self._flush_loop, name="chat-log-flusher", daemon=True)
+            self.flusher.start()
+
+    def _acquire(self, path):
+        evicted = []
+        with self.lock:
+            handle = self.handles.get(path)
+            if handle is None:
+                handle = ChatLogHandle(path)
+                self.handles[path] = handle
+            self.handles.move_to_end(path)
+            while len(self.handles) > self.max_open:
+                evicted.append(self.handles.popitem(last=False)[1])
+        for old_handle in evicted:
+            with old_handle.lock:
+                old_handle.close(self.fsync_mode != 'none')
+            self._closed(old_handle)
+        return handle
+
+    def _closed(self, handle):
+        if handle.unsynced:
+            with self.lock:
+                self.unsynced_paths.add(handle.path)
+
+    def write(self, path, text):
+        while True:
+            handle = self._acquire(path)
+            with handle.lock:
+                if handle.file is None:
+                    continue
+                handle.file.write(text)
+                handle.pending_bytes += len(text)
+                handle.unsynced = True
+                if self.fsync_mode == 'always':
+                    handle.flush(True)
+                elif (handle.pending_bytes >= self.flush_bytes
+                      or time.monotonic() - handle.last_flush >= self.flush_interval):
+                    handle.flush(self.fsync_mode == 'flush')
+                return
+
+    def close_file(self, path):
+        with self.lock:
+            handle = self.handles.pop(path, None)
+            unsynced = path in self.unsynced_paths
+            self.unsynced_paths.discard(path)
+        if handle is not None:
+            with handle.lock:
+                handle.close(True)
+        elif unsynced and os.path.exists(path):
+            sync_path(path)
+
+    def sync_all(self):
+        with self.lock:
+            handles = list(self.handles.values())
+            paths = self.unsynced_paths
+            self.unsynced_paths = set()
+        for handle in handles:
+            with handle.lock:
+                if handle.file is not None:
+                    if handle.unsynced:
+                        handle.flush(True)
+                elif handle.unsynced:
+                    paths.add(handle.path)
+        for path in paths:
+            try:
+                sync_path(path)
+            except FileNotFoundError:
+                pass
+
+    def flush_all(self):
+        with self.lock:
+            handles = list(self.handles.values())
+        for handle in handles:
+            with handle.lock:
+                if handle.file is not None and handle.pending_bytes:
+                    handle.flush(self.fsync_mode != 'none')
+
+    def _flush_loop(self):
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.flush_all()
+            except Exception as e:
+                logger.error(
+                    f"Ошибка фоновой записи логов чатов на диск: {e}", exc_info=True)
+
+    def close_all(self):
+        self.stop_event.set()
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
+        with self.lock:
+            handles = list(self.handles.values())
+            self.handles.clear()
+        for handle in handles:
+            with handle.lock:
+                handle.close(self.fsync_mode != 'none')
+            self._closed(handle)
+
+
+def list_segments(chat_dir):
+    segments = []
+    try:
+        names = os.listdir(chat_dir)
+    except FileNotFoundError:
+        return segments
+    for name in names:
+        match = SEGMENT_RE.match(name)
+        if match:
+            segments.append((int(match.group(1)), os.path.join(chat_dir, name)))
+    segments.sort()
+    return segments
+
+
+def open_segment(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError(
+                f"zstandard is required to read {path}: pip install zstandard")
+        return zstandard.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+def compress_segment(path, compression):
+    compressed_path = path + COMPRESSED_EXTENSIONS[compression]
+    tmp_path = compressed_path + '.tmp'
+    if compression == 'zstd':
+        with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            zstandard.ZstdCompressor().copy_stream(src, dst)
+    else:
+        with open(path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+            for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                dst.write(chunk)
+    sync_path(tmp_path)
+    os.replace(tmp_path, compressed_path)
+    os.remove(path)
+    return compressed_path
+
+
+def open_segment_for_write(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wt', encoding='utf-8')
+    if path.endswith('.zst'):
+        return zstandard.open(path, 'wt', encoding='utf-8')
+    return open(path, 'w', encoding='utf-8')
+
+
+def read_segment(path):
+    with open_segment(path) as segment:
+        for line in segment:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def is_superseded(path):
+    return path.endswith(SEGMENT_EXTENSION) and any(
+        os.path.exists(path + ext) for ext in COMPRESSED_EXTENSIONS.values())
+
+
+def iter_chat_entries(chat_dir, expand=True):
+    for _, path in list_segments(chat_dir):
+        if is_superseded(path):
+            continue
+        for log_entry in read_segment(path):
+            if expand:
+                yield from expand_entry(log_entry)
+            else:
+                yield log_entry
+
+
+def text_diff(old, new):
+    ops = []
+    matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            ops.append([i1, i2, new[j1:j2]])
+    return ops
+
+
+def apply_text_diff(old, ops):
+    parts = []
+    position = 0
+    for i1, i2, replacement in ops:
+        parts.append(old[position:i1])
+        parts.append(replacement)
+        position = i2
+    parts.append(old[position:])
+    return ''.join(parts)
+
+
+def build_edit_history(versions):
+    history = []
+    for newer, older in zip(reversed(versions[1:]), reversed(versions[:-1])):
+        step = {
+            'timestamp': older['timestamp'],
+            'text': text_diff(newer['text'] or '', older['text'] or ''),
+            'caption': text_diff(newer['caption'] or '', older['caption'] or ''),
+        }
+        if older.get('location') != newer.get('location'):
+            step['location'] = older.get('location')
+        history.append(step)
+    return history
+
+
+def entry_versions(log_entry, latest_timestamp):
+    text = log_entry.get('text')
+    caption = log_entry.get('caption')
+    location = log_entry.get('location')
+    versions = [{'timestamp': latest_timestamp, 'text': text,
+                 'caption': caption, 'location': location}]
+    for step in log_entry.get('edit_history') or []:
+        text = apply_text_diff(text or '', step['text']) or None
+        caption = apply_text_diff(caption or '', step['caption']) or None
+        location = step.get('location', location)
+        versions.append({'timestamp': step['timestamp'], 'text': text,
+                         'caption': caption, 'location': location})
+    versions.reverse()
+    return versions
+
+
+def expand_entry(log_entry):
+    if log_entry.get('edited') or not log_entry.get('edit_history'):
+        yield log_entry
+        return
+    versions = entry_versions(log_entry, log_entry['edit_date'])
+    original = dict(log_entry)
+    del original['edit_history']
+    del original['edit_date']
+    original['text'] = versions[0]['text']
+    original['caption'] = versions[0]['caption']
+    original['location'] = versions[0]['location']
+    yield original
+    for version in versions[1:]:
+        edited = dict(original)
+        edited.update(edited=True, timestamp_unix=version['timestamp'],
+                      text=version['text'], caption=version['caption'],
+                      location=version['location'])
+        yield edited
+
+
+def merge_edits(original, edits):
+    versions = [{'timestamp': original['timestamp_unix'], 'text': original.get('text'),
+                 'caption': original.get('caption'), 'location': original.get('location')}]
+    for edit in edits:
+        versions.extend(entry_versions(edit, edit['timestamp_unix']))
+    merged = dict(original)
+    merged['text'] = versions[-1]['text']
+    merged['caption'] = versions[-1]['caption']
+    merged['location'] = versions[-1]['location']
+    merged['edit_date'] = versions[-1]['timestamp']
+    merged['edit_history'] = build_edit_history(versions)
+    return merged
+
+
+def compact_segment(path):
+    originals = set()
+    edits = {}
+    download_updates = {}
+    superseded_downloads = 0
+    for position, log_entry in enumerate(read_segment(path)):
+        message_id = log_entry['message_id']
+        if log_entry.get('download_update'):
+            if message_id in download_updates:
+                superseded_downloads += 1
+            download_updates[message_id] = position
+            continue
+        if not log_entry.get('edited'):
+            originals.add(message_id)
+        elif message_id in originals:
+            edits.setdefault(message_id, []).append(log_entry)
+    if not edits and not superseded_downloads:
+        return 0
+
+    tmp_path = path + '.tmp' + os.path.splitext(path)[1]
+    with open_segment_for_write(tmp_path) as output:
+        for position, log_entry in enumerate(read_segment(path)):
+            message_id = log_entry['message_id']
+            if log_entry.get('download_update') and download_updates[message_id] != position:
+                continue
+            if message_id in edits and not log_entry.get('download_update'):
+                if log_entry.get('edited'):
+                    continue
+                log_entry = merge_edits(log_entry, edits[message_id])
+            output.write(json.dumps(log_entry, ensure_ascii=False,
+                                    separators=(',', ':')) + '\n')
+    sync_path(tmp_path)
+    os.replace(tmp_path, path)
+    return sum(len(message_edits) for message_edits in edits.values()) + superseded_downloads
+
+
+def compact_chat(chat_dir, compression='none'):
+    marker_path = os.path.join(chat_dir, COMPACTED_MARKER)
+    try:
+        with open(marker_path, 'r', encoding='utf-8') as f:
+            compacted = set(json.load(f))
+    except FileNotFoundError:
+        compacted = set()
+
+    segments = list_segments(chat_dir)[:-1]
+    merged = 0
+    for _, path in segments:
+        name = os.path.basename(path)
+        if name in compacted or is_superseded(path) or not os.path.exists(path):
+            continue
+        if compression != 'none' and path.endswith(SEGMENT_EXTENSION):
+            continue
+        merged += compact_segment(path)
+        compacted.add(name)
+        tmp_marker = marker_path + '.tmp'
+        with open(tmp_marker, 'w', encoding='utf-8') as f:
+            json.dump(sorted(compacted), f)
+        os.replace(tmp_marker, marker_path)
+    return merged
+
+
+def compact_archive(root_dir, compression='none'):
+    merged = 0
+    for name in sorted(os.listdir(root_dir)):
+        chat_dir = os.path.join(root_dir, name)
+        if os.path.isdir(chat_dir):
+            merged += compact_chat(chat_dir, compression)
+    return merged
+
+
+class SegmentCompressor:
+    def __init__(self, compression):
+        if compression == 'zstd' and zstandard is None:
+            logger.warning(
+                "Модуль zstandard не установлен, сегменты архива будут сжиматься gzip.")
+            compression = 'gzip'
+        if compression not in ('none', 'gzip', 'zstd'):
+            raise ValueError(
+                f"compression must be 'none', 'gzip' or 'zstd', got {compression!r}")
+        self.compression = compression
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def submit(self, path, callback=None):
+        if self.compression == 'none':
+            return
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+            future = self.executor.submit(compress_segment, path, self.compression)
+        future.add_done_callback(lambda done: self._done(path, done, callback))
+
+    def _done(self, path, future, callback):
+        try:
+            compressed_path = future.result()
+        except Exception as e:
+            logger.error(
+                f"Не удалось сжать сегмент архива {path}: {e}", exc_info=True)
+            return
+        if callback is not None:
+            try:
+                callback(compressed_path)
+            except Exception as e:
+                logger.error(
+                    f"Ошибка обработки сжатого сегмента {compressed_path}: {e}", exc_info=True)
+
+    def close(self):
+        with self.lock:
+            executor = self.executor
+            self.executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+class StructuredArchive:
+    def __init__(self, root_dir, writer, max_segment_bytes, compressor):
+        self.root_dir = root_dir
+        self.writer = writer
+        self.max_segment_bytes = max_segment_bytes
+        self.compressor = compressor
+        self.chats = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.compaction_thread = None
+
+    def chat_dir(self, chat_id):
+        return os.path.join(self.root_dir, str(chat_id))
+
+    def _chat_state(self, chat_id):
+        with self.lock:
+            state = self.chats.get(chat_id)
+            if state is None:
+                chat_dir = self.chat_dir(chat_id)
+                os.makedirs(chat_dir, exist_ok=True)
+                segments = list_segments(chat_dir)
+                index = segments[-1][0] if segments else 1
+                path = os.path.join(
+                    chat_dir, f"{SEGMENT_PREFIX}{index:06d}{SEGMENT_EXTENSION}")
+                if segments and segments[-1][1] != path:
+                    index += 1
+                    path = os.path.join(
+                        chat_dir, f"{SEGMENT_PREFIX}{index:06d}{SEGMENT_EXTENSION}")
+                size = os.path.getsize(path) if os.path.exists(path) else 0
+                state = {'lock': threading.Lock(), 'dir': chat_dir,
+                         'index': index, 'path': path, 'size': size}
+                self.chats[chat_id] = state
+            return state
+
+    def write(self, log_entry):
+        chat_id = log_entry['chat']['id']
+        line = json.dumps(log_entry, ensure_ascii=False,
+                          separators=(',', ':')) + '\n'
+        state = self._chat_state(chat_id)
+        with state['lock']:
+            self.writer.write(state['path'], line)
+            state['size'] += len(line.encode('utf-8'))
+            if state['size'] >= self.max_segment_bytes:
+                self._rotate(state)
+
+    def _rotate(self, state):
+        closed_path = state['path']
+        self.writer.close_file(closed_path)
+        state['index'] += 1
+        state['path'] = os.path.join(
+            state['dir'], f"{SEGMENT_PREFIX}{state['index']:06d}{SEGMENT_EXTENSION}")
+        state['size'] = 0
+        self.compressor.submit(closed_path)
+
+    def start_compaction(self, interval):
+        if interval > 0:
+            self.compaction_thread = threading.Thread(
+                target=self._compaction_loop, args=(interval,), name="segment-compaction", daemon=True)
+            self.compaction_thread.start()
+
+    def _compaction_loop(self, interval):
+        while not self.stop_event.wait(interval):
+            try:
+                merged = compact_archive(
+                    self.root_dir, self.compressor.compression)
+                if merged:
+                    logger.info(
+                        f"Сжатие архива: объединено записей об изменениях и загрузках: {merged}")
+            except Exception as e:
+                logger.error(
+                    f"Ошибка сжатия истории изменений в архиве: {e}", exc_info=True)
+
+    def close(self):
+        self.stop_event.set()
+        if self.compaction_thread is not None:
+            self.compaction_thread.join()
+            self.compaction_thread = None
+
+
+def segment_time(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime('%Y%m%d-%H%M%S')
+
+
+def load_manifest(chat_dir):
+    try:
+        with open(os.path.join(chat_dir, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'segments': [], 'active': None}
+
+
+def save_manifest(chat_dir, manifest):
+    path = os.path.join(chat_dir, MANIFEST_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+def manifest_segments(chat_dir, since=None, until=None):
+    manifest = load_manifest(chat_dir)
+    entries = list(manifest['segments'])
+    if manifest.get('active'):
+        entries.append(manifest['active'])
+    for entry in entries:
+        if since is not None and entry.get('end') is not None and entry['end'] < since:
+            continue
+        if until is not None and entry.get('start') is not None and entry['start'] > until:
+            continue
+        yield os.path.join(chat_dir, entry['file'])
+
+
+class RotatingTextLogs:
+    def __init__(self, writer, max_bytes, max_age, compressor):
+        self.writer = writer
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compressor = compressor
+        self.dirs = {}
+        self.lock = threading.Lock()
+
+    def _dir_state(self, chat_dir):
+        with self.lock:
+            state = self.dirs.get(chat_dir)
+            if state is None:
+                os.makedirs(chat_dir, exist_ok=True)
+                state = {'lock': threading.RLock(), 'dir': chat_dir,
+                         'manifest': load_manifest(chat_dir), 'path': None,
+                         'size': 0, 'start': None, 'end': None}
+                self.dirs[chat_dir] = state
+            return state
+
+    def _activate(self, state, path):
+        active = state['manifest'].get('active')
+        state['path'] = path
+        state['size'] = os.path.getsize(path) if os.path.exists(path) else 0
+        if active and active['file'] == os.path.basename(path) and state['size']:
+            state['start'] = active['start']
+            state['end'] = active['end']
+        else:
+            state['start'] = None
+            state['end'] = None
+
+    def write(self, path, text, timestamp):
+        state = self._dir_state(os.path.dirname(path) or '.')
+        with state['lock']:
+            if state['path'] != path:
+                if state['path'] is not None and state['size']:
+                    self._rotate(state)
+                self._activate(state, path)
+            elif state['size'] and (state['size'] >= self.max_bytes or (
+                    self.max_age > 0 and state['start'] is not None and
+                    timestamp - state['start'] >= self.max_age)):
+                self._rotate(state)
+                self._activate(state, path)
+
+            self.writer.write(path, text)
+            state['size'] += len(text.encode('utf-8'))
+            state['end'] = max(state['end'] or timestamp, timestamp)
+            if state['start'] is None:
+                state['start'] = timestamp
+                self._save_active(state)
+
+    def _save_active(self, state):
+        state['manifest']['active'] = {
+            'file': os.path.basename(state['path']),
+            'start': state['start'], 'end': state['end']}
+        save_manifest(state['dir'], state['manifest'])
+
+    def rename_active(self, old_path, new_path):
+        state = self._dir_state(os.path.dirname(old_path) or '.')
+        with state['lock']:
+            self.writer.close_file(old_path)
+            os.rename(old_path, new_path)
+            if state['path'] == old_path:
+                state['path'] = new_path
+            active = state['manifest'].get('active')
+            if active and active['file'] == os.path.basename(old_path):
+                active['file'] = os.path.basename(new_path)
+                save_manifest(state['dir'], state['manifest'])
+
+    def _rotate(self, state):
+        path = state['path']
+        self.writer.close_file(path)
+        if not os.path.exists(path):
+            logger.warning(f"Лог {path} не найден при ротации, начат новый лог")
+            state['manifest']['active'] = None
+            save_manifest(state['dir'], state['manifest'])
+            state['path'] = None
+            state['size'] = 0
+            return
+        base, extension = os.path.splitext(os.path.basename(path))
+        start = state['start'] if state['start'] is not None else state['end'] or 0
+        name = f"{base}.{segment_time(start)}_{segment_time(state['end'] or start)}{extension}"
+        counter = 1
+        while os.path.exists(os.path.join(state['dir'], name)):
+            counter += 1
+            name = f"{base}.{segment_time(start)}_{segment_time(state['end'] or start)}.{counter}{extension}"
+        closed_path = os.path.join(state['dir'], name)
+        os.rename(path, closed_path)
+
+        state['manifest']['segments'].append({
+            'file': name, 'start': state['start'], 'end': state['end'], 'bytes': state['size']})
+        state['manifest']['active'] = None
+        save_manifest(state['dir'], state['manifest'])
+        state['path'] = None
+        state['size'] = 0
+        self.compressor.submit(
+            closed_path, lambda compressed_path: self._compressed(state, name, compressed_path))
+
+    def _compressed(self, state, name, compressed_path):
+        with state['lock']:
+            for entry in state['manifest']['segments']:
+                if entry['file'] == name:
+                    entry['file'] = os.path.basename(compressed_path)
+                    entry['compressed'] = True
+            save_manifest(state['dir'], state['manifest'])
+
+    def close(self):
+        with self.lock:
+            states = list(self.dirs.values())
+        for state in states:
+            with state['lock']:
+                if state['path'] is not None and state['start'] is not None:
+                    self._save_active(state)
+
+
+def render_chat(chat_dir, output):
+    count = 0
+    for log_entry in iter_chat_entries(chat_dir):
+        output.write(format_log_entry_human_readable(log_entry))
+        count += 1
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Работа со структурированным архивом чатов (JSON Lines).")
+    parser.add_argument('--root', default=STRUCTURED_ARCHIVE_DIR,
+                        help="папка структурированного архива")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    render_parser = subparsers.add_parser(
+        'render', help="восстановить текстовый лог чата из архива")
+    render_parser.add_argument('chat_id', help="ID чата")
+    render_parser.add_argument('-o', '--output',
+                               help="файл для записи (по умолчанию stdout)")
+    compact_parser = subparsers.add_parser(
+        'compact', help="объединить изменения сообщений в закрытых сегментах")
+    compact_parser.add_argument('--compression', default=SEGMENT_COMPRESSION,
+                                help="сжатие сегментов архива (none, gzip, zstd)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'compact':
+        merged = compact_archive(args.root, args.compression)
+        print(f"Объединено записей об изменениях и загрузках: {merged}", file=sys.stderr)
+        return
+
+    chat_dir = os.path.join(args.root, str(args.chat_id))
+    if args.command == 'render':
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as output:
+                count = render_chat(chat_dir, output)
+        else:
+            count = render_chat(chat_dir, sys.stdout)
+        print(f"Записано сообщений: {count}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
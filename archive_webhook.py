@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import telebot
+from aiohttp import web
+
+
+WEBHOOK_HOST = os.getenv('ARCHIVER_WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('ARCHIVER_WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('ARCHIVER_WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = os.getenv('ARCHIVER_WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.getenv('ARCHIVER_WEBHOOK_SECRET', '')
+WEBHOOK_CONCURRENCY = int(os.getenv('ARCHIVER_WEBHOOK_CONCURRENCY', '8'))
+WEBHOOK_MAX_PENDING = int(os.getenv('ARCHIVER_WEBHOOK_MAX_PENDING', '100'))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('ARCHIVER_WEBHOOK_DRAIN_TIMEOUT', '30'))
+
+logger = logging.getLogger('TeleBot')
+
+
+class WebhookServer:
+    def __init__(self, process_updates, concurrency=WEBHOOK_CONCURRENCY, max_pending=WEBHOOK_MAX_PENDING,
+                 is_saturated=None, secret_token=WEBHOOK_SECRET, path=WEBHOOK_PATH,
+                 drain_timeout=WEBHOOK_DRAIN_TIMEOUT):
+        self.process_updates = process_updates
+        self.concurrency = max(1, concurrency)
+        self.max_pending = max_pending
+        self.is_saturated = is_saturated
+        self.secret_token = secret_token
+        self.path = path
+        self.drain_timeout = drain_timeout
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix="webhook")
+        self.semaphore = None
+        self.pending = 0
+        self.draining = False
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def _busy_response(self):
+        self.rejected += 1
+        return web.Response(status=503, text="busy", headers={'Retry-After': '1'})
+
+    async def handle_update(self, request):
+        if self.draining:
+            return self._busy_response()
+        if self.secret_token and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+            return web.Response(status=403, text="forbidden")
+        if self.pending >= self.concurrency + self.max_pending:
+            return self._busy_response()
+        if self.is_saturated is not None and self.is_saturated():
+            return self._busy_response()
+
+        try:
+            update = telebot.types.Update.de_json(await request.text())
+        except Exception as e:
+            logger.warning(f"Некорректное обновление в webhook: {e}")
+            return web.Response(status=400, text="bad update")
+
+        self.pending += 1
+        try:
+            async with self.semaphore:
+                await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.process_updates, [update])
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(
+                f"Ошибка обработки обновления {update.update_id} из webhook: {e}", exc_info=True)
+            return web.Response(status=503, text="error", headers={'Retry-After': '5'})
+        finally:
+            self.pending -= 1
+        return web.Response(text="ok")
+
+    async def _on_startup(self, app):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def _on_shutdown(self, app):
+        self.draining = True
+        logger.info(
+            f"Остановка webhook: ожидание обработки {self.pending} обновлений...")
+        deadline = time.monotonic() + self.drain_timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.pending:
+            logger.warning(
+                f"Webhook остановлен, не дождавшись обработки {self.pending} обновлений.")
+        self.executor.shutdown(wait=True)
+
+    def build_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.on_startup.append(self._on_startup)
+        app.on_shutdown.append(self._on_shutdown)
+        return app
+
+    def run(self, host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+        web.run_app(self.build_app(), host=host, port=port, print=None)
+
+
+def run_webhook(bot, process_updates, is_saturated=None):
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                        secret_token=WEBHOOK_SECRET or None,
+                        max_connections=WEBHOOK_CONCURRENCY)
+        logger.info(f"Webhook установлен: {WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH}")
+    else:
+        logger.warning(
+            "ARCHIVER_WEBHOOK_URL не задан, webhook в Telegram не регистрируется.")
+    server = WebhookServer(process_updates, is_saturated=is_saturated)
+    logger.info(
+        f"Запуск webhook-сервера на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH} (параллельно: {server.concurrency})")
+    server.run()
+    logger.info(
+        f"Webhook-сервер остановлен. Обработано: {server.processed}, отклонено: {server.rejected}, ошибок: {server.failed}")
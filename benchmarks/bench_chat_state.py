@@ -0,0 +1,60 @@
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive_bot_v1 as archiver
+from telebot import types
+
+MESSAGES = int(os.getenv('BENCH_MESSAGES', '200000'))
+CHATS = int(os.getenv('BENCH_CHATS', '100'))
+
+
+def make_chats():
+    chats = []
+    for i in range(CHATS):
+        chat = types.Chat(id=-1000000 - i, type='supergroup',
+                          title=f"Benchmark group: \"{i}\" / test chat")
+        user = types.User(id=i, is_bot=False, first_name='Bench')
+        chats.append((chat, user))
+    return chats
+
+
+def uncached(chat, user):
+    log_filename = archiver.get_log_filename(chat, user)
+    chat_media_dir = os.path.join(archiver.MEDIA_ARCHIVE_DIR,
+                                  archiver.sanitize_filename(str(chat.id)))
+    os.makedirs(chat_media_dir, exist_ok=True)
+    return log_filename, chat_media_dir
+
+
+def cached(chat, user, cache):
+    chat_state = cache.get(chat, user)
+    cache.ensure_media_dir(chat_state)
+    return chat_state['log_filename'], chat_state['media_dir']
+
+
+def main():
+    chats = make_chats()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        cache = archiver.ChatStateCache(os.path.join(workdir, 'chat_logs.json'), 'keep')
+
+        started = time.perf_counter()
+        for i in range(MESSAGES):
+            uncached(*chats[i % CHATS])
+        baseline = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for i in range(MESSAGES):
+            cached(*chats[i % CHATS], cache)
+        elapsed = time.perf_counter() - started
+
+    print(f"get_log_filename + makedirs: {baseline / MESSAGES * 1e6:.2f} us/msg")
+    print(f"ChatStateCache:              {elapsed / MESSAGES * 1e6:.2f} us/msg, x{baseline / elapsed:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive_bot_v1 as archiver
+
+MESSAGES = int(os.getenv('BENCH_MESSAGES', '50000'))
+CHATS = int(os.getenv('BENCH_CHATS', '50'))
+THREADS = int(os.getenv('BENCH_THREADS', '4'))
+ENTRY = archiver.format_log_entry_human_readable({
+    'message_id': 1, 'timestamp_unix': 1700000000,
+    'chat': {'id': -100, 'type': 'supergroup', 'title': 'Benchmark', 'username': None},
+    'user': {'id': 1, 'is_bot': False, 'first_name': 'Bench', 'last_name': None, 'username': None},
+    'text': 'x' * 200, 'caption': None, 'content_type': 'text', 'edited': False,
+})
+
+
+def open_per_message(path, text, lock=threading.Lock()):
+    with lock:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(text)
+
+
+def run(name, write, workdir):
+    paths = [os.path.join(workdir, f"chatlog_{name}_{i}.log")
+             for i in range(CHATS)]
+    per_thread = MESSAGES // THREADS
+
+    def worker(offset):
+        for i in range(per_thread):
+            write(paths[(offset + i) % CHATS], ENTRY)
+
+    threads = [threading.Thread(target=worker, args=(t,))
+               for t in range(THREADS)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def main():
+    with tempfile.TemporaryDirectory() as workdir:
+        baseline = run('open', open_per_message, workdir)
+        print(f"open-per-message: {baseline:.3f}s, {MESSAGES / baseline:,.0f} msg/s")
+
+        for fsync_mode in ('none', 'flush'):
+            writer = archiver.ChatLogWriter(archiver.LOG_MAX_OPEN_FILES, archiver.LOG_FLUSH_INTERVAL,
+                                            archiver.LOG_FLUSH_BYTES, fsync_mode)
+            writer.start()
+            elapsed = run(f"pool_{fsync_mode}", writer.write, workdir)
+            writer.close_all()
+            print(f"pooled (fsync={fsync_mode}): {elapsed:.3f}s, {MESSAGES / elapsed:,.0f} msg/s, "
+                  f"x{baseline / elapsed:.1f}")
+
+
+if __name__ == '__main__':
+    main()
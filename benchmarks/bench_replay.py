@@ -0,0 +1,283 @@
+import argparse
+import http.server
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+os.environ.setdefault('ARCHIVER_API_RATE', '0')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import telebot
+from telebot import types
+
+import archive_bot_v1 as archiver
+
+TOKEN = '0:replay'
+SCENARIOS = ('text', 'media', 'albums', 'edits', 'many_chats')
+MESSAGES = int(os.getenv('BENCH_MESSAGES', '5000'))
+CHUNK = b'\0' * 65536
+
+
+class FakeBotApiHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    fault_rate = 0.0
+    faults = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _get_file(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode() if length else ''
+        query = self.path.partition('?')[2]
+        match = re.search(r'file_id=([^&"]+)', body or query) or re.search(r'"file_id"\s*:\s*"([^"]+)"', body)
+        file_id = match.group(1)
+        result = {'file_id': file_id, 'file_unique_id': file_id,
+                  'file_size': file_size(file_id), 'file_path': f"files/{file_id}.bin"}
+        self._send(200, json.dumps({'ok': True, 'result': result}).encode())
+
+    def _download(self):
+        file_id = os.path.splitext(os.path.basename(self.path))[0]
+        size = file_size(file_id)
+        start = 0
+        status = 200
+        match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+        content_head = file_id.encode().ljust(len(CHUNK), b'\0')
+        position = start
+        while position < size:
+            block = content_head if position < len(CHUNK) else CHUNK
+            chunk = block[position % len(CHUNK):min(len(CHUNK), size - position + position % len(CHUNK))]
+            self.wfile.write(chunk)
+            position += len(chunk)
+
+    def _fault(self):
+        FakeBotApiHandler.faults += 1
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        if random.random() < 0.5:
+            body = {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                    'parameters': {'retry_after': 1}}
+            self._send(429, json.dumps(body).encode(), headers={'Retry-After': '1'})
+        else:
+            self._send(502, b'Bad Gateway', content_type='text/plain')
+
+    def do_GET(self):
+        if self.fault_rate and random.random() < self.fault_rate:
+            self._fault()
+        elif self.path.startswith('/file/'):
+            self._download()
+        elif '/getFile' in self.path:
+            self._get_file()
+        else:
+            self._send(404, b'{"ok": false, "error_code": 404, "description": "Not Found"}')
+
+    do_POST = do_GET
+
+
+def file_size(file_id):
+    return int(file_id.split('-')[1])
+
+
+def start_fake_api():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeBotApiHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_message(message_id, chat_id, **fields):
+    data = {
+        'message_id': message_id, 'date': 1700000000 + message_id,
+        'chat': {'id': chat_id, 'type': 'supergroup', 'title': f"Replay {chat_id}"},
+        'from': {'id': message_id % 100 + 1, 'is_bot': False, 'first_name': 'Replay'},
+    }
+    data.update(fields)
+    return data
+
+
+def media_fields(i):
+    kind = i % 4
+    if kind == 0:
+        return {'photo': [{'file_id': f"photo-{100 * 1024}-{i}", 'file_unique_id': f"photo-{100 * 1024}-{i}",
+                           'width': 1280, 'height': 720}], 'caption': f"photo {i}"}
+    if kind == 1:
+        return {'video': {'file_id': f"video-{5 * 1024 * 1024}-{i}", 'file_unique_id': f"video-{5 * 1024 * 1024}-{i}",
+                          'width': 1280, 'height': 720, 'duration': 10}}
+    if kind == 2:
+        return {'document': {'file_id': f"doc-{512 * 1024}-{i}", 'file_unique_id': f"doc-{512 * 1024}-{i}",
+                             'file_name': f"document_{i}.pdf"}}
+    sticker_id = f"sticker-{30 * 1024}-{i % 20}"
+    return {'sticker': {'file_id': sticker_id, 'file_unique_id': sticker_id, 'width': 512, 'height': 512,
+                        'is_animated': False, 'is_video': False, 'type': 'regular', 'emoji': '🙂'}}
+
+
+def generate(scenario, count):
+    for i in range(count):
+        if scenario == 'text':
+            yield 'message', make_message(i, -1000 - i % 10, text=f"replay message {i} " * 5)
+        elif scenario == 'media':
+            yield 'message', make_message(i, -1000 - i % 10, **media_fields(i))
+        elif scenario == 'albums':
+            group = i // 10
+            fields = media_fields(4 * i + i % 2)
+            fields['media_group_id'] = f"album-{group}"
+            fields.pop('caption', None)
+            if i % 10 == 0:
+                fields['caption'] = f"album {group}"
+            yield 'message', make_message(i, -1000 - group % 10, **fields)
+        elif scenario == 'edits':
+            message_id = i // 10
+            message = make_message(message_id, -1000 - message_id % 10, text=f"message {message_id} v{i % 10}")
+            if i % 10 == 0:
+                yield 'message', message
+            else:
+                message['edit_date'] = message['date'] + i % 10
+                yield 'edited_message', message
+        elif scenario == 'many_chats':
+            yield 'message', make_message(i, -1000 - i % 1000, text=f"replay message {i}")
+
+
+def load_recorded(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            update = json.loads(line)
+            for kind in ('message', 'edited_message'):
+                if kind in update:
+                    yield kind, update[kind]
+
+
+def disk_usage(path):
+    seen = set()
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            stat = os.stat(os.path.join(dirpath, name))
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_size
+    return total
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_scenario(scenario, updates_file=None, fault_rate=0.0):
+    workdir = tempfile.mkdtemp(prefix=f"replay_{scenario}_")
+    os.chdir(workdir)
+    FakeBotApiHandler.fault_rate = fault_rate
+    server = start_fake_api()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    telebot.apihelper.API_URL = base_url + "/bot{0}/{1}"
+    archiver.FILE_URL = base_url + "/file/bot{0}/{1}"
+    archiver.logger.setLevel('WARNING')
+    archiver.METRICS_PORT = 0
+    archiver.create_bot(TOKEN)
+    archiver.start_services()
+
+    events = list(load_recorded(updates_file) if updates_file else generate(scenario, MESSAGES))
+    messages = [(kind, types.Message.de_json(data)) for kind, data in events]
+    latencies = []
+    started = time.perf_counter()
+    for kind, message in messages:
+        handler_started = time.perf_counter()
+        if kind == 'edited_message':
+            archiver.archive_edited_message(message)
+        else:
+            archiver.archive_message(message)
+        latencies.append(time.perf_counter() - handler_started)
+    handled = time.perf_counter() - started
+    archiver.stop_services()
+    api_stats = archiver.api_client.stats()
+    total = time.perf_counter() - started
+    server.shutdown()
+
+    peak_rss = None
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {
+        'scenario': scenario if not updates_file else os.path.basename(updates_file),
+        'messages': len(messages),
+        'handler_msg_per_s': len(messages) / handled if handled else 0.0,
+        'end_to_end_msg_per_s': len(messages) / total if total else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'bytes_written': disk_usage(workdir),
+        'faults': FakeBotApiHandler.faults,
+        'api_retries': api_stats['retries'],
+        'peak_rss_mb': peak_rss,
+        'workdir': workdir,
+    }
+
+
+def print_result(result):
+    peak = f"{result['peak_rss_mb']:.1f} MB" if result['peak_rss_mb'] is not None else "n/a"
+    print(f"{result['scenario']:>12}: {result['messages']} msgs, "
+          f"handlers {result['handler_msg_per_s']:,.0f} msg/s (p50 {result['p50_ms']:.3f} ms, "
+          f"p99 {result['p99_ms']:.3f} ms), end-to-end {result['end_to_end_msg_per_s']:,.0f} msg/s, "
+          f"{result['bytes_written'] / 1024 / 1024:.1f} MB written, peak RSS {peak}")
+    if result['faults']:
+        print(f"{'':>12}  {result['faults']} injected 429/5xx responses, {result['api_retries']} retries")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay synthetic or recorded updates through the archiver against a fake Bot API.")
+    parser.add_argument('--scenario', choices=SCENARIOS)
+    parser.add_argument('--updates', help="JSON Lines file with recorded Telegram updates")
+    parser.add_argument('--faults', type=float, default=0.0,
+                        help="fraction of fake Bot API responses replaced by 429 or 502 errors")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+
+    if args.scenario or args.updates:
+        result = run_scenario(args.scenario, args.updates, args.faults)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print_result(result)
+        return
+
+    for scenario in SCENARIOS:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--scenario', scenario,
+                                 '--faults', str(args.faults), '--json'],
+                                check=True, capture_output=True, text=True).stdout
+        print_result(json.loads(output.strip().splitlines()[-1]))
+
+
+if __name__ == '__main__':
+    main()
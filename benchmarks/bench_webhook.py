@@ -0,0 +1,101 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+UPDATES_FILE = os.path.abspath(os.getenv('BENCH_UPDATES_FILE', '')) if os.getenv('BENCH_UPDATES_FILE') else None
+WORKDIR = tempfile.mkdtemp(prefix='bench_webhook_')
+os.chdir(WORKDIR)
+
+import aiohttp
+from aiohttp import web
+
+import archive_bot_v1 as archiver
+from archive_webhook import WebhookServer
+from telebot import types
+
+UPDATES = int(os.getenv('BENCH_UPDATES', '5000'))
+CHATS = int(os.getenv('BENCH_CHATS', '50'))
+CLIENT_CONCURRENCY = int(os.getenv('BENCH_CLIENT_CONCURRENCY', '32'))
+
+
+def load_updates():
+    if UPDATES_FILE:
+        with open(UPDATES_FILE, 'r', encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip()]
+    updates = []
+    for i in range(UPDATES):
+        chat_id = -1000000 - i % CHATS
+        updates.append(json.dumps({
+            'update_id': i + 1,
+            'message': {
+                'message_id': i + 1, 'date': 1700000000 + i,
+                'chat': {'id': chat_id, 'type': 'supergroup', 'title': f"Group {chat_id}"},
+                'from': {'id': i % 500, 'is_bot': False, 'first_name': 'User'},
+                'text': f"benchmark message {i}",
+            },
+        }))
+    return updates
+
+
+def bench_polling(updates):
+    started = time.perf_counter()
+    for i in range(0, len(updates), 100):
+        archiver.bot.process_new_updates(
+            [types.Update.de_json(raw) for raw in updates[i:i + 100]])
+    return time.perf_counter() - started
+
+
+async def bench_webhook(updates):
+    server = WebhookServer(archiver.bot.process_new_updates, secret_token='')
+    runner = web.AppRunner(server.build_app())
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    url = f"http://127.0.0.1:{port}{server.path}"
+
+    queue = asyncio.Queue()
+    for raw in updates:
+        queue.put_nowait(raw)
+
+    async def client(session):
+        while not queue.empty():
+            raw = queue.get_nowait()
+            while True:
+                async with session.post(url, data=raw) as response:
+                    if response.status != 503:
+                        break
+                await asyncio.sleep(0.01)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(client(session) for _ in range(CLIENT_CONCURRENCY)))
+    elapsed = time.perf_counter() - started
+    await runner.cleanup()
+    return elapsed
+
+
+def main():
+    archiver.create_bot('0:benchmark')
+    archiver.logger.setLevel('WARNING')
+    archiver.log_writer.start()
+    archiver.search_index.start()
+    updates = load_updates()
+
+    polling = bench_polling(updates)
+    print(f"polling (sequential process_new_updates): {len(updates) / polling:,.0f} updates/s")
+    webhook = asyncio.run(bench_webhook(updates))
+    print(f"webhook ({CLIENT_CONCURRENCY} concurrent POSTs): {len(updates) / webhook:,.0f} updates/s")
+
+    archiver.search_index.close()
+    archiver.log_writer.close_all()
+    print(f"work dir: {WORKDIR}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import pytest
+import requests
+import telebot
+
+import archive_api
+from archive_api import BotApiClient, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(archive_api, 'time', clock)
+    return clock
+
+
+def api_error(error_code, retry_after=None):
+    result_json = {'ok': False, 'error_code': error_code, 'description': "error"}
+    if retry_after is not None:
+        result_json['parameters'] = {'retry_after': retry_after}
+    return telebot.apihelper.ApiTelegramException('getFile', None, result_json)
+
+
+def failing(*errors, result='ok'):
+    calls = []
+
+    def func():
+        calls.append(len(calls))
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+    return func, calls
+
+
+def make_client(**kwargs):
+    kwargs.setdefault('rate', 0)
+    kwargs.setdefault('backoff_base', 0.5)
+    kwargs.setdefault('backoff_max', 30)
+    return BotApiClient('TOKEN', **kwargs)
+
+
+def test_call_retries_transient_errors_then_succeeds(clock):
+    client = make_client(max_retries=5)
+    func, calls = failing(api_error(502), requests.ConnectionError("reset"))
+
+    assert client.call(func) == 'ok'
+    assert len(calls) == 3
+    assert client.stats()['requests'] == 3 and client.retries == 2 and client.throttled == 0
+    assert len(clock.sleeps) == 2
+    assert 0.25 <= clock.sleeps[0] <= 0.5 and 0.5 <= clock.sleeps[1] <= 1.0
+
+
+def test_call_honors_retry_after_and_pauses_limiter(clock):
+    client = make_client(backoff_base=0.01)
+    func, calls = failing(api_error(429, retry_after=5))
+
+    assert client.call(func) == 'ok'
+    assert len(calls) == 2
+    assert client.throttled == 1
+    assert clock.sleeps == [5]
+    assert client.limiter.paused_until == 1005.0
+
+
+def test_call_gives_up_after_max_retries(clock):
+    client = make_client(max_retries=2)
+    error = api_error(503)
+    func, calls = failing(error, error, error, error)
+
+    with pytest.raises(telebot.apihelper.ApiTelegramException):
+        client.call(func)
+    assert len(calls) == 3
+    assert client.retries == 2
+
+
+def test_call_does_not_retry_client_errors(clock):
+    client = make_client()
+    func, calls = failing(api_error(400))
+
+    with pytest.raises(telebot.apihelper.ApiTelegramException):
+        client.call(func)
+    assert len(calls) == 1
+    assert client.retries == 0 and clock.sleeps == []
+
+
+def test_token_bucket_waits_out_pause_and_rate(clock):
+    bucket = TokenBucket(10, 1)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == pytest.approx(0.1)
+
+    bucket.pause(3)
+    bucket.pause(1)
+    assert bucket.acquire() == pytest.approx(3)
+    assert clock.now == pytest.approx(1003.1)
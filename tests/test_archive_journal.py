@@ -0,0 +1,90 @@
+import os
+
+import pytest
+from telebot import types
+
+import archive_journal
+from archive_journal import CHECKPOINT_NAME, UpdateJournal, list_journal_segments
+
+
+def make_update(update_id):
+    return types.Update.de_json({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 1700000000, 'text': f"message {update_id}",
+        'chat': {'id': -1, 'type': 'supergroup', 'title': "Journal"},
+        'from': {'id': 1, 'is_bot': False, 'first_name': "Test"}}})
+
+
+def open_journal(journal_dir, segment_bytes=1 << 20, flush_logs=lambda: None):
+    journal = UpdateJournal(str(journal_dir), 0, 3600, segment_bytes, 0, flush_logs)
+    return journal, journal.open()
+
+
+def crash(journal):
+    with journal.cond:
+        journal.stopping = True
+        journal.cond.notify_all()
+    journal.thread.join()
+    journal.file.close()
+
+
+def test_unfinished_updates_are_replayed_after_crash(tmp_path):
+    journal, unfinished = open_journal(tmp_path)
+    assert unfinished == []
+    journal.append([make_update(10), make_update(11)])
+    journal.append([make_update(12)])
+    journal.finish(10)
+    journal.finish(12)
+    journal.checkpoint(settle_delay=0)
+    journal.finish(11)
+    crash(journal)
+
+    journal, unfinished = open_journal(tmp_path)
+    assert [data['update_id'] for data in unfinished] == [11]
+    assert unfinished[0]['message']['text'] == "message 11"
+    assert journal.last_update_id == 12
+    journal.close()
+
+
+def test_checkpoint_syncs_logs_and_deletes_finished_segments(tmp_path):
+    calls = []
+    journal, _ = open_journal(tmp_path, segment_bytes=1, flush_logs=lambda: calls.append('flush'))
+    for update_id in (1, 2, 3):
+        journal.append([make_update(update_id)])
+    assert len(list_journal_segments(str(tmp_path))) == 4
+
+    journal.finish(1)
+    journal.finish(2)
+    assert journal.checkpoint(settle_delay=0) == 3
+    assert calls == ['flush']
+    assert [segment for segment, _ in list_journal_segments(str(tmp_path))] == [3, 4]
+
+    journal.finish(3)
+    journal.close()
+    assert [segment for segment, _ in list_journal_segments(str(tmp_path))] == [4]
+    with open(os.path.join(str(tmp_path), CHECKPOINT_NAME), encoding='utf-8') as f:
+        assert f.read() == '{"last_update_id": 3}'
+
+    journal, unfinished = open_journal(tmp_path)
+    assert unfinished == []
+    assert journal.last_update_id == 3
+    journal.close()
+
+
+def test_failed_journal_write_is_reported_to_the_caller(tmp_path, monkeypatch):
+    journal, _ = open_journal(tmp_path)
+    real_fsync = os.fsync
+
+    def failing_fsync(fd):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(archive_journal.os, 'fsync', failing_fsync)
+    with pytest.raises(IOError):
+        journal.append([make_update(1)])
+    monkeypatch.setattr(archive_journal.os, 'fsync', real_fsync)
+    assert journal.last_update_id == -1
+    journal.append([make_update(2)])
+    crash(journal)
+
+    journal, unfinished = open_journal(tmp_path)
+    assert [data['update_id'] for data in unfinished] == [2]
+    journal.close()
@@ -0,0 +1,10 @@
+from archive_search import parse_time
+
+
+def test_parse_time_end_of_day_includes_whole_until_date():
+    start = parse_time('2024-02-01')
+    assert start == 1706745600
+    assert parse_time('2024-02-01', end_of_day=True) == start + 86399
+    assert parse_time('2024-02-01T10:00', end_of_day=True) == start + 10 * 3600
+    assert parse_time('2024-02-01T00:00+03:00', end_of_day=True) == start - 3 * 3600
+    assert parse_time('1706745600', end_of_day=True) == start
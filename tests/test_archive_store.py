@@ -0,0 +1,144 @@
+import os
+
+import archive_store
+from archive_store import ChatLogWriter, RotatingTextLogs, load_manifest
+
+
+class InlineCompressor:
+    compression = 'none'
+
+    def submit(self, path, callback=None):
+        if callback is not None:
+            callback(path)
+
+
+def make_text_logs(max_bytes=1 << 20, max_age=86400):
+    writer = ChatLogWriter(16, 0, 1, 'none')
+    return writer, RotatingTextLogs(writer, max_bytes, max_age, InlineCompressor())
+
+
+def test_rename_active_keeps_writing_to_renamed_log(tmp_path):
+    writer, text_logs = make_text_logs()
+    old_path = str(tmp_path / 'chatlog_Old.log')
+    new_path = str(tmp_path / 'chatlog_New.log')
+    text_logs.write(old_path, "first\n", 100)
+    text_logs.rename_active(old_path, new_path)
+    text_logs.write(new_path, "second\n", 101)
+    text_logs.write(new_path, "third\n", 102)
+    writer.close_all()
+
+    assert not os.path.exists(old_path)
+    with open(new_path, encoding='utf-8') as f:
+        assert f.read() == "first\nsecond\nthird\n"
+    manifest = load_manifest(str(tmp_path))
+    assert manifest['segments'] == []
+    assert manifest['active']['file'] == 'chatlog_New.log'
+
+
+def test_rotate_survives_missing_active_log(tmp_path):
+    writer, text_logs = make_text_logs(max_bytes=1)
+    path = str(tmp_path / 'chatlog_Chat.log')
+    text_logs.write(path, "first\n", 100)
+    writer.close_file(path)
+    os.remove(path)
+    text_logs.write(path, "second\n", 101)
+    text_logs.write(path, "third\n", 102)
+    writer.close_all()
+
+    segments = load_manifest(str(tmp_path))['segments']
+    assert len(segments) == 1
+    with open(os.path.join(str(tmp_path), segments[0]['file']), encoding='utf-8') as f:
+        assert f.read() == "second\n"
+    with open(path, encoding='utf-8') as f:
+        assert f.read() == "third\n"
+
+
+
+def test_zero_max_age_rotates_by_size_only(tmp_path):
+    writer, text_logs = make_text_logs(max_age=0)
+    path = str(tmp_path / 'chatlog_Chat.log')
+    for timestamp in range(100, 105):
+        text_logs.write(path, "message\n", timestamp)
+    writer.close_all()
+
+    assert load_manifest(str(tmp_path))['segments'] == []
+    with open(path, encoding='utf-8') as f:
+        assert f.read() == "message\n" * 5
+
+def write_segment(path, entries):
+    with open(path, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(archive_store.json.dumps(entry, ensure_ascii=False) + '\n')
+
+
+def test_text_diff_round_trip():
+    pairs = [("", "hello"), ("hello", ""), ("hello world", "hello brave new world"),
+             ("привет, мир", "привет, дивный мир 🙂"), ("abc", "abc"), ("line 1\nline 2", "line 2\nline 3")]
+    for old, new in pairs:
+        assert archive_store.apply_text_diff(old, archive_store.text_diff(old, new)) == new
+        assert archive_store.apply_text_diff(new, archive_store.text_diff(new, old)) == old
+
+
+def test_compact_segment_merges_edits_and_keeps_latest_download(tmp_path):
+    path = str(tmp_path / 'segment_000001.jsonl')
+    coalesced = {'message_id': 1, 'edited': True, 'timestamp_unix': 130, 'text': "v4", 'caption': None,
+                 'edit_history': archive_store.build_edit_history([
+                     {'timestamp': 120, 'text': "v3", 'caption': None},
+                     {'timestamp': 130, 'text': "v4", 'caption': None}])}
+    write_segment(path, [
+        {'message_id': 1, 'timestamp_unix': 100, 'text': "v1", 'caption': None},
+        {'message_id': 2, 'timestamp_unix': 101, 'text': "other", 'caption': None},
+        {'message_id': 1, 'edited': True, 'timestamp_unix': 110, 'text': "v2", 'caption': None},
+        {'message_id': 3, 'timestamp_unix': 102, 'text': None, 'caption': None, 'file_id': 'f'},
+        {'message_id': 3, 'download_update': True, 'download_error': "timeout"},
+        coalesced,
+        {'message_id': 3, 'download_update': True, 'local_path': "media/f.jpg", 'download_error': None},
+    ])
+
+    assert archive_store.compact_segment(path) == 3
+    entries = list(archive_store.read_segment(path))
+    assert [entry['message_id'] for entry in entries] == [1, 2, 3, 3]
+    assert entries[0]['text'] == "v4"
+    assert entries[3]['local_path'] == "media/f.jpg"
+
+    expanded = [entry for entry in archive_store.iter_chat_entries(str(tmp_path)) if entry['message_id'] == 1]
+    assert [(entry['timestamp_unix'], entry['text'], entry.get('edited', False)) for entry in expanded] == [
+        (100, "v1", False), (110, "v2", True), (120, "v3", True), (130, "v4", True)]
+    assert archive_store.compact_segment(path) == 0
+
+
+
+def test_compact_segment_keeps_every_live_location_point(tmp_path):
+    path = str(tmp_path / 'segment_000001.jsonl')
+    points = [{'latitude': n, 'longitude': n} for n in range(1, 5)]
+    coalesced = {'message_id': 1, 'edited': True, 'timestamp_unix': 130, 'text': None, 'caption': None,
+                 'location': points[3], 'edit_history': archive_store.build_edit_history([
+                     {'timestamp': 120, 'text': None, 'caption': None, 'location': points[2]},
+                     {'timestamp': 130, 'text': None, 'caption': None, 'location': points[3]}])}
+    write_segment(path, [
+        {'message_id': 1, 'timestamp_unix': 100, 'text': None, 'caption': None, 'location': points[0]},
+        {'message_id': 1, 'edited': True, 'timestamp_unix': 110, 'text': None, 'caption': None,
+         'location': points[1]},
+        coalesced,
+    ])
+
+    assert archive_store.compact_segment(path) == 2
+    assert list(archive_store.read_segment(path))[0]['location'] == points[3]
+    expanded = list(archive_store.iter_chat_entries(str(tmp_path)))
+    assert [(entry['timestamp_unix'], entry['location']) for entry in expanded] == list(
+        zip([100, 110, 120, 130], points))
+
+def test_sync_all_fsyncs_open_and_evicted_logs_in_none_mode(tmp_path, monkeypatch):
+    synced = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(archive_store.os, 'fsync', lambda fd: synced.append(fd) or real_fsync(fd))
+    writer = ChatLogWriter(1, 0, 1 << 20, 'none')
+    writer.write(str(tmp_path / 'a.log'), "a\n")
+    writer.write(str(tmp_path / 'b.log'), "b\n")
+    assert synced == []
+
+    writer.sync_all()
+    assert len(synced) == 2
+    writer.sync_all()
+    assert len(synced) == 2
+    writer.close_all()
@@ -0,0 +1,47 @@
+import asyncio
+import json
+import os
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import archive_bot_v1 as archiver
+import archive_journal
+from archive_journal import UpdateJournal
+from archive_webhook import WebhookServer
+
+UPDATE = json.dumps({'update_id': 1, 'message': {
+    'message_id': 1, 'date': 1700000000, 'text': "webhook",
+    'chat': {'id': -1, 'type': 'supergroup', 'title': "Webhook"},
+    'from': {'id': 1, 'is_bot': False, 'first_name': "Test"}}})
+
+
+def post_update(server):
+    async def post():
+        async with TestClient(TestServer(server.build_app())) as client:
+            response = await client.post(server.path, data=UPDATE)
+            return response.status, response.headers.get('Retry-After')
+    return asyncio.run(post())
+
+
+def test_update_is_not_acknowledged_when_journal_write_fails(tmp_path, monkeypatch):
+    journal = UpdateJournal(str(tmp_path), 0, 3600, 1 << 20, 0, lambda: None)
+    journal.open()
+    bot = archiver.ArchiverBot('123:TEST', threaded=False)
+    bot.journal = journal
+    real_fsync = os.fsync
+
+    def failing_fsync(fd):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(archive_journal.os, 'fsync', failing_fsync)
+    server = WebhookServer(bot.process_new_updates, secret_token='')
+    assert post_update(server) == (503, '5')
+    assert (server.processed, server.failed) == (0, 1)
+    assert journal.last_update_id == -1
+
+    monkeypatch.setattr(archive_journal.os, 'fsync', real_fsync)
+    server = WebhookServer(bot.process_new_updates, secret_token='')
+    assert post_update(server)[0] == 200
+    assert (server.processed, server.failed) == (1, 0)
+    assert journal.last_update_id == 1
+    journal.close()
@@ -0,0 +1,149 @@
+import hashlib
+import http.server
+import os
+import re
+import threading
+import types
+
+import pytest
+
+import archive_bot_v1 as archiver
+from archive_api import BotApiClient
+from archive_media import PARTIAL_FILE_SUFFIX, DownloadRetryQueue
+
+PAYLOAD = bytes(range(256)) * 40
+
+
+def make_job(message_id, chat_id=-1):
+    return {'chat_id': chat_id, 'file_id': f"file-{message_id}", 'log_entry': {'message_id': message_id}}
+
+
+def make_queue(tmp_path, submitted, max_attempts=2, base_delay=0, accept=True):
+    def submit(job):
+        if accept:
+            submitted.append(job)
+        return accept
+    return DownloadRetryQueue(str(tmp_path / 'retries.sqlite3'), max_attempts, base_delay, base_delay, 1, submit)
+
+
+def test_retry_queue_resubmits_due_jobs_until_attempts_run_out(tmp_path):
+    submitted = []
+    queue = make_queue(tmp_path, submitted)
+
+    assert queue.add(dict(make_job(1), job_id=7))
+    queue.resubmit_due()
+    assert submitted == [dict(make_job(1), retry_attempts=1)]
+    assert queue.add(submitted[-1])
+    queue.resubmit_due()
+    assert submitted[-1]['retry_attempts'] == 2
+    assert not queue.add(submitted[-1])
+    assert (queue.scheduled, queue.resubmitted, queue.abandoned) == (2, 2, 1)
+    assert queue.pending() == 0
+    queue.close()
+
+
+def test_retry_queue_keeps_jobs_that_are_not_due_or_not_accepted(tmp_path):
+    submitted = []
+    queue = make_queue(tmp_path, submitted, base_delay=3600)
+    queue.add(make_job(1))
+    queue.resubmit_due()
+    assert submitted == [] and queue.pending() == 1
+    queue.close()
+
+    queue = make_queue(tmp_path, submitted, accept=False)
+    queue.add(make_job(2))
+    queue.resubmit_due()
+    assert queue.pending() == 2
+    queue.close()
+
+
+def test_retry_queue_recovers_unfinished_jobs(tmp_path):
+    submitted = []
+    queue = make_queue(tmp_path, submitted)
+    finished, unfinished = make_job(1), make_job(2)
+    queue.track(finished)
+    queue.track(unfinished)
+    queue.finish(finished)
+    assert 'job_id' not in finished
+    queue.close()
+
+    queue = make_queue(tmp_path, submitted)
+    assert queue.recover() == 1
+    assert queue.recover() == 0
+    queue.resubmit_due()
+    assert [job['file_id'] for job in submitted] == ['file-2']
+    assert queue.pending() == 0
+    queue.close()
+
+
+class FakeFileHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    mode = 'range'
+    ranges = []
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        header = self.headers.get('Range')
+        self.ranges.append(header)
+        match = re.match(r'bytes=(\d+)-', header or '')
+        if match is None or self.mode == 'ignore':
+            self._send(200, PAYLOAD)
+        elif self.mode == 'expired':
+            self._send(416, b'')
+        else:
+            self._send(206, PAYLOAD[int(match.group(1)):])
+
+
+@pytest.fixture
+def file_server(monkeypatch):
+    FakeFileHandler.ranges = []
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeFileHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = BotApiClient('TOKEN', rate=0)
+    monkeypatch.setattr(archiver, 'FILE_URL', f"http://127.0.0.1:{server.server_port}/file/bot{{0}}/{{1}}")
+    monkeypatch.setattr(archiver, 'bot', types.SimpleNamespace(token='TOKEN'))
+    monkeypatch.setattr(archiver, 'api_client', client)
+    yield FakeFileHandler
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+
+def download_with_partial(tmp_path, monkeypatch, mode, partial):
+    monkeypatch.setattr(FakeFileHandler, 'mode', mode)
+    save_path = str(tmp_path / 'file.bin')
+    with open(save_path + PARTIAL_FILE_SUFFIX, 'wb') as f:
+        f.write(partial)
+    hasher = hashlib.sha256()
+    size = archiver.stream_download('documents/file.bin', save_path, chunk_size=1000, hasher=hasher)
+
+    assert size == len(PAYLOAD)
+    assert not os.path.exists(save_path + PARTIAL_FILE_SUFFIX)
+    with open(save_path, 'rb') as f:
+        assert f.read() == PAYLOAD
+    assert hasher.hexdigest() == hashlib.sha256(PAYLOAD).hexdigest()
+
+
+def test_stream_download_resumes_partial_file(tmp_path, monkeypatch, file_server):
+    download_with_partial(tmp_path, monkeypatch, 'range', PAYLOAD[:3000])
+    assert file_server.ranges == ['bytes=3000-']
+
+
+def test_stream_download_restarts_when_range_is_not_satisfiable(tmp_path, monkeypatch, file_server):
+    download_with_partial(tmp_path, monkeypatch, 'expired', b'stale' * 100)
+    assert file_server.ranges == ['bytes=500-', None]
+
+
+def test_stream_download_overwrites_partial_when_range_is_ignored(tmp_path, monkeypatch, file_server):
+    download_with_partial(tmp_path, monkeypatch, 'ignore', b'stale' * 100)
+    assert file_server.ranges == ['bytes=500-']
@@ -0,0 +1,158 @@
+import os
+import threading
+import time
+
+from telebot import types
+
+import archive_bot_v1 as archiver
+from archive_media import MediaDedupIndex, MediaStorage
+
+
+def make_storage(tmp_path, chat_max_bytes=0, total_max_bytes=0, skip_larger=None, max_age=0, cold_dir=''):
+    dedup = MediaDedupIndex(str(tmp_path / 'dedup.sqlite3'), str(tmp_path / '_blobs'), 100)
+    storage = MediaStorage(str(tmp_path / 'storage.sqlite3'), dedup, chat_max_bytes, total_max_bytes,
+                           skip_larger or {}, max_age, cold_dir, 0)
+    storage.open(str(tmp_path / 'media'))
+    return dedup, storage
+
+
+def save_file(tmp_path, dedup, storage, chat_id, file_unique_id, size):
+    blob_path = dedup.blob_path_for(file_unique_id, '.bin')
+    if dedup.lookup(file_unique_id) is None:
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        with open(blob_path, 'wb') as f:
+            f.write(b'\0' * size)
+        dedup.add(file_unique_id, blob_path, size)
+        new_bytes = size
+    else:
+        new_bytes = 0
+    chat_dir = tmp_path / 'media' / str(chat_id)
+    os.makedirs(str(chat_dir), exist_ok=True)
+    path = dedup.link_into(blob_path, str(chat_dir / f"{file_unique_id}.bin"))
+    storage.record(chat_id, file_unique_id, path, size, 'document', new_bytes)
+    return path
+
+
+def test_check_reserves_until_release(tmp_path):
+    _, storage = make_storage(tmp_path, chat_max_bytes=3000, skip_larger={'sticker': 100})
+    assert storage.check(-1, 'sticker', 's', 500) is not None
+    assert storage.check(-1, 'document', 'a', 2000) is None
+    assert storage.check(-1, 'document', 'b', 2000) is not None
+    storage.release(-1, 'a')
+    assert storage.check(-1, 'document', 'b', 2000) is None
+    assert storage.stats()['skipped'] == {'size': 1, 'chat_quota': 1, 'total_quota': 0}
+
+
+def test_usage_is_recorded_once_and_survives_reopen(tmp_path):
+    dedup, storage = make_storage(tmp_path)
+    save_file(tmp_path, dedup, storage, -1, 'a', 1000)
+    save_file(tmp_path, dedup, storage, -1, 'a', 1000)
+    save_file(tmp_path, dedup, storage, -2, 'a', 1000)
+    save_file(tmp_path, dedup, storage, -2, 'b', 500)
+    assert storage.usage(-1)['bytes'] == 1000
+    assert storage.usage(-2) == {'bytes': 1500, 'files': 2, 'cold_bytes': 0, 'cold_files': 0}
+    assert storage.total_bytes == 1500
+    storage.close()
+
+    _, storage = make_storage(tmp_path)
+    assert storage.usage(-2)['bytes'] == 1500
+    assert storage.total_bytes == 1500
+
+
+def test_expire_moves_to_cold_and_keeps_shared_blob(tmp_path):
+    cold_dir = str(tmp_path / 'cold')
+    dedup, storage = make_storage(tmp_path, max_age=3600, cold_dir=cold_dir)
+    save_file(tmp_path, dedup, storage, -1, 'a', 1000)
+    save_file(tmp_path, dedup, storage, -2, 'a', 1000)
+    with storage.lock:
+        storage.conn.execute("UPDATE media_files SET added = 0 WHERE chat_id = -1")
+        storage.conn.commit()
+
+    assert storage.expire() == 1
+    assert os.path.exists(os.path.join(cold_dir, '-1', 'a.bin'))
+    assert dedup.lookup('a') is not None
+    assert storage.total_bytes == 1000
+    assert storage.usage(-1) == {'bytes': 0, 'files': 0, 'cold_bytes': 1000, 'cold_files': 1}
+
+    storage.max_age = 0.001
+    time.sleep(0.01)
+    assert storage.expire() == 1
+    assert dedup.lookup('a') is None
+    assert storage.total_bytes == 0
+    assert os.path.exists(os.path.join(cold_dir, '-2', 'a.bin'))
+
+
+def test_expire_deletes_files_and_blobs(tmp_path):
+    dedup, storage = make_storage(tmp_path, max_age=0.001)
+    path = save_file(tmp_path, dedup, storage, -1, 'a', 1000)
+    blob_path = dedup.blob_path_for('a', '.bin')
+    time.sleep(0.01)
+    assert storage.expire() == 1
+    assert not os.path.exists(path)
+    assert not os.path.exists(blob_path)
+    assert storage.usage(-1)['files'] == 0
+    assert storage.total_bytes == 0
+    assert storage.stats()['expired'] == {'deleted': 1, 'moved': 0}
+
+
+
+def test_backfilled_legacy_files_count_towards_total_quota(tmp_path):
+    chat_dir = tmp_path / 'media' / '-2'
+    os.makedirs(str(chat_dir))
+    legacy_path = str(chat_dir / 'old.bin')
+    with open(legacy_path, 'wb') as f:
+        f.write(b'\0' * 700)
+    dedup, storage = make_storage(tmp_path, total_max_bytes=2000)
+    assert storage.total_bytes == 700
+    save_file(tmp_path, dedup, storage, -1, 'a', 1000)
+    storage.close()
+
+    dedup, storage = make_storage(tmp_path, total_max_bytes=2000, max_age=0.001)
+    assert storage.total_bytes == 1700
+    assert storage.check(-3, 'document', 'b', 500) is not None
+    assert storage.check(-3, 'document', 'a', 1000) is None
+    assert storage.total_reserved == 0 and storage.chat_reserved == {-3: 1000}
+    storage.release(-3, 'a')
+    assert storage.chat_reserved == {}
+
+    time.sleep(0.01)
+    assert storage.expire() == 2
+    assert not os.path.exists(legacy_path)
+    assert storage.total_bytes == 0
+
+def test_reservation_is_released_when_download_queue_is_full(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _, storage = make_storage(tmp_path, chat_max_bytes=3000)
+    monkeypatch.setattr(archiver, 'media_storage', storage)
+    monkeypatch.setattr(archiver, 'submit_download', lambda job: False)
+    for message_id in range(4):
+        message = types.Message.de_json({
+            'message_id': message_id, 'date': 1700000000,
+            'chat': {'id': -5, 'type': 'supergroup', 'title': "Quota"},
+            'from': {'id': 1, 'is_bot': False, 'first_name': "Test"},
+            'document': {'file_id': f"doc-{message_id}", 'file_unique_id': f"doc-{message_id}",
+                         'file_size': 2000, 'file_name': "file.pdf"}})
+        archiver.archive_message(message)
+    assert storage.chat_reserved == {}
+    assert storage.stats()['skipped']['chat_quota'] == 0
+    archiver.log_writer.close_all()
+
+
+def test_file_lock_only_serializes_the_same_file(tmp_path):
+    dedup = MediaDedupIndex(str(tmp_path / 'dedup.sqlite3'), str(tmp_path / '_blobs'), 100)
+    acquired = {'a': threading.Event(), 'b': threading.Event()}
+
+    def lock_file(file_unique_id):
+        with dedup.file_lock(file_unique_id):
+            acquired[file_unique_id].set()
+
+    with dedup.file_lock('a'):
+        threads = [threading.Thread(target=lock_file, args=(file_unique_id,)) for file_unique_id in ('a', 'b')]
+        for thread in threads:
+            thread.start()
+        assert acquired['b'].wait(1)
+        assert not acquired['a'].wait(0.1)
+    for thread in threads:
+        thread.join(1)
+    assert acquired['a'].is_set()
+    assert dedup.file_locks == {}